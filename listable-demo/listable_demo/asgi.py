@@ -0,0 +1,10 @@
+"""
+ASGI config for the listable demo project, e.g. for serving the async
+staff-list-async view with `uvicorn listable_demo.asgi:application`.
+"""
+import os
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "listable_demo.settings")
+
+from django.core.asgi import get_asgi_application
+application = get_asgi_application()
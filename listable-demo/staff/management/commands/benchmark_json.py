@@ -0,0 +1,45 @@
+import json
+import timeit
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.urls import reverse
+
+from listable import utils
+from staff.views import StaffList
+
+
+class Command(BaseCommand):
+    help = "Compare the LISTABLE_JSON_ENCODER serializers on a page of the StaffList ajax response"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=500, help="page size to request")
+        parser.add_argument("--number", type=int, default=50, help="number of times to run each benchmark")
+
+    def handle(self, *args, **options):
+        request = RequestFactory().get(reverse("staff-list"), {
+            "sEcho": 1,
+            "iColumns": len(StaffList.fields),
+            "iDisplayStart": 0,
+            "iDisplayLength": options["rows"],
+        }, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        request.user = AnonymousUser()
+        view = StaffList.as_view()
+
+        payload = json.loads(view(request).content)
+        self.stdout.write("%d rows, %d runs each (ms per run)" % (len(payload["aaData"]), options["number"]))
+
+        for name in ("json", "orjson"):
+            try:
+                encoder = utils.get_json_encoder(name)
+            except Exception as e:
+                self.stdout.write("%-8s unavailable (%s)" % (name, e))
+                continue
+
+            encode = timeit.timeit(lambda: encoder(payload), number=options["number"]) / options["number"]
+            with mock.patch("listable.settings.LISTABLE_JSON_ENCODER", name):
+                response = timeit.timeit(lambda: view(request), number=options["number"]) / options["number"]
+
+            self.stdout.write("%-8s encode: %8.3f  full response: %8.3f" % (name, encode * 1000, response * 1000))
@@ -13,4 +13,11 @@ urlpatterns = [
         views.StaffListStaticLiveFilters.as_view(),
         name="staff-list-static-live-filters",
     ),
+    path('staff-list-async/', views.StaffListAsync.as_view(), name="staff-list-async"),
+    path('staff-list-keyset/', views.StaffListKeyset.as_view(), name="staff-list-keyset"),
+    path('staff-list-ajax-options/', views.StaffListAjaxOptions.as_view(), name="staff-list-ajax-options"),
+    path('generic-a-list/', views.GenericModelAList.as_view(), name="generic-a-list"),
+    path('staff-list-batch/', views.StaffListBatch.as_view(), name="staff-list-batch"),
+    path('staff-list-generic/', views.StaffListGeneric.as_view(), name="staff-list-generic"),
+    path('staff-list-no-generic/', views.StaffListNoGeneric.as_view(), name="staff-list-no-generic"),
 ]
@@ -1,6 +1,10 @@
+from collections import defaultdict
+
+from django.db.models import Case, CharField, OuterRef, Subquery, When
 from django.utils.translation import gettext as _
 from django.contrib.contenttypes.models import ContentType
-from listable.views import BaseListableView, SELECT, SELECT_MULTI, DATE, DATE_RANGE
+from listable.views import AsyncBaseListableView, BaseListableView, SELECT, SELECT_MULTI, SELECT_MULTI_FROM_MULTI, DATE, DATE_RANGE
+from listable.views import EXPORT_CSV, EXPORT_NDJSON, EXPORT_XLSX
 from listable.views import TODAY, YESTERDAY, TOMORROW, LAST_7_DAYS, LAST_14_DAYS, LAST_30_DAYS, LAST_365_DAYS, THIS_WEEK, THIS_MONTH, THIS_QUARTER, THIS_YEAR, LAST_WEEK, LAST_MONTH, LAST_QUARTER, LAST_YEAR, WEEK_TO_DATE, MONTH_TO_DATE, QUARTER_TO_DATE, YEAR_TO_DATE, NEXT_WEEK, NEXT_MONTH, NEXT_QUARTER, NEXT_YEAR
 
 from . import models
@@ -65,26 +69,21 @@ class StaffList(BaseListableView):
 
     select_related = ("department", "position", "department__business", "contract_type")
 
+    export_formats = (EXPORT_CSV, EXPORT_NDJSON, EXPORT_XLSX)
+
     def generic(self, obj):
         return obj.generic_object.name
 
     def name(self, staff):
         return staff.name()
 
-    def get_extra(self):
-        cta = ContentType.objects.get_for_model(models.GenericModelA)
-        ctb = ContentType.objects.get_for_model(models.GenericModelB)
-
-        extraq = """
-         CASE
-            WHEN content_type_id = {0}
-                THEN (SELECT name AS genericname from staff_genericmodela WHERE object_id = staff_genericmodela.id)
-            WHEN content_type_id = {1}
-                THEN (SELECT name AS genericname from staff_genericmodelb WHERE object_id = staff_genericmodelb.id)
-         END
-         """.format(cta.pk, ctb.pk)
+    def get_annotations(self):
+        whens = []
+        for model in (models.GenericModelA, models.GenericModelB):
+            names = model.objects.filter(pk=OuterRef("object_id")).values("name")[:1]
+            whens.append(When(content_type=ContentType.objects.get_for_model(model), then=Subquery(names)))
 
-        return {"select": {'genericname': extraq}}
+        return {"genericname": Case(*whens, output_field=CharField())}
 
 
 class StaffListLiveFilters(StaffList):
@@ -92,7 +91,88 @@ class StaffListLiveFilters(StaffList):
     template_name = "staff/staff_list_live_filters.html"
 
 
+class StaffListAsync(AsyncBaseListableView, StaffListLiveFilters):
+    template_name = "staff/staff_list_async.html"
+
+
 class StaffListStaticLiveFilters(StaffListLiveFilters):
     static_live_filters = {
         "is_manager": ["True", "False"],
     }
+
+
+class StaffListKeyset(StaffList):
+    keyset_pagination = True
+
+
+class StaffListAjaxOptions(StaffList):
+    ajax_options = ("position__name", "contract_type__name")
+    ajax_options_page_size = 2
+    template_name = "staff/staff_list_ajax_options.html"
+
+
+class StaffListNoGeneric(StaffList):
+    """Staff list without the generic relation column (and therefore no subqueries)"""
+
+    fields = tuple(f for f in StaffList.fields if f != "genericname")
+
+    def get_annotations(self):
+        return {}
+
+
+class StaffListBatch(StaffListNoGeneric):
+    """Staff list with a generic relation column loaded by a batch formatter"""
+
+    fields = StaffListNoGeneric.fields + ("generic",)
+
+    order_fields = dict(StaffList.order_fields, generic=False)
+
+    search_fields = dict(StaffList.search_fields, generic=False)
+
+    def format_generic_batch(self, objects):
+        """Load the generic objects for a page with one query per content type"""
+
+        object_ids = defaultdict(list)
+        for obj in objects:
+            object_ids[obj.content_type_id].append(obj.object_id)
+
+        names = {}
+        for content_type_id, ids in object_ids.items():
+            model = ContentType.objects.get_for_id(content_type_id).model_class()
+            for pk, name in model.objects.filter(pk__in=ids).values_list("pk", "name"):
+                names[(content_type_id, pk)] = name
+
+        return {obj.pk: names.get((obj.content_type_id, obj.object_id)) for obj in objects}
+
+
+class StaffListGeneric(StaffListNoGeneric):
+    """Staff list with a column traversing the generic relation"""
+
+    fields = StaffListNoGeneric.fields + ("generic_object__name",)
+
+    widgets = dict(StaffList.widgets, generic_object__name=SELECT)
+
+    headers = dict(StaffList.headers, generic_object__name=_("Generic"))
+
+
+class GenericModelAList(BaseListableView):
+    """List of generic model A's with the last names of their staff"""
+
+    model = models.GenericModelA
+    queryset = models.GenericModelA.objects.order_by("pk")
+
+    fields = (
+        "id",
+        "name",
+        "staff__last_name",
+    )
+
+    widgets = {
+        "staff__last_name": SELECT_MULTI_FROM_MULTI,
+    }
+
+    headers = {
+        "staff__last_name": _("Staff"),
+    }
+
+    template_name = "staff/generic_a_list.html"
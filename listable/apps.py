@@ -0,0 +1,15 @@
+from django.apps import AppConfig
+
+from . import settings as li_settings
+
+
+class ListableConfig(AppConfig):
+
+    name = "listable"
+
+    def ready(self):
+        # by default the cache invalidation receivers are only connected once
+        # a view using the cache is defined or used (see cache.connect_invalidation)
+        if li_settings.LISTABLE_CACHE_INVALIDATION is True:
+            from .cache import connect_invalidation
+            connect_invalidation()
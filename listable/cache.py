@@ -0,0 +1,186 @@
+"""
+Cross request caching for listable views.
+
+Cached values are keyed on a name, the SQL of the queryset they were computed
+from and a "generation" token for every model the queryset touches. Saving or
+deleting an instance of a model (see apps.ListableConfig.ready) deletes that
+model's generation token, so every cached value depending on the model is
+orphaned and recomputed on the next request. The signal receivers are only
+connected once a view using the cache is defined or used (see
+connect_invalidation) unless LISTABLE_CACHE_INVALIDATION is True. Bulk operations that don't send
+signals (e.g. QuerySet.update) are only picked up once the cache timeout expires.
+"""
+import hashlib
+import threading
+import uuid
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from . import settings as li_settings
+from . import utils
+
+
+_invalidation_connected = False
+_invalidation_lock = threading.Lock()
+
+
+def get_cache():
+    connect_invalidation()
+    return caches[li_settings.LISTABLE_CACHE_ALIAS]
+
+
+def connect_invalidation():
+    """
+    Connect the signal receivers invalidating cached values (once) unless
+    LISTABLE_CACHE_INVALIDATION is False.
+    """
+
+    global _invalidation_connected
+
+    if _invalidation_connected or li_settings.LISTABLE_CACHE_INVALIDATION is False:
+        return
+
+    with _invalidation_lock:
+        post_save.connect(invalidate_model, dispatch_uid="listable_post_save")
+        post_delete.connect(invalidate_model, dispatch_uid="listable_post_delete")
+        m2m_changed.connect(invalidate_m2m, dispatch_uid="listable_m2m_changed")
+        _invalidation_connected = True
+
+
+def generation_key(model):
+    return "listable:generation:%s" % model._meta.label_lower
+
+
+def query_tables(query):
+    """
+    Return the set of tables used by a Query including those of the
+    subqueries (e.g. EXISTS filters or Subquery annotations) it contains.
+    """
+
+    tables = {join.table_name for join in query.alias_map.values()}
+    expressions = list(query.annotations.values()) + [query.where]
+    return tables | expression_tables(expressions)
+
+
+def expression_tables(expressions):
+    """Return the set of tables used by the subqueries of the input expressions"""
+
+    tables = set()
+    expressions = list(expressions)
+    while expressions:
+        expression = expressions.pop()
+        if expression is None:
+            continue
+        if hasattr(expression, "alias_map"):
+            # a Query, e.g. the right hand side of a pk__in=<queryset> lookup
+            tables |= query_tables(expression)
+            continue
+
+        subquery = getattr(expression, "query", None)
+        if hasattr(subquery, "alias_map"):
+            tables |= query_tables(subquery)
+
+        if hasattr(expression, "children"):
+            # WhereNode
+            expressions.extend(expression.children)
+        elif hasattr(expression, "get_source_expressions"):
+            expressions.extend(expression.get_source_expressions())
+    return tables
+
+
+def table_models(tables):
+    """Return the set of models for the input table names"""
+    return {m for m in apps.get_models(include_auto_created=True) if m._meta.db_table in tables}
+
+
+def queryset_models(qs):
+    """Return the set of models whose tables are used by the input queryset (including its subqueries)"""
+    return {qs.model} | table_models(query_tables(qs.query))
+
+
+def expression_models(expression):
+    """Return the set of models whose tables are used by the subqueries of an expression"""
+    return table_models(expression_tables([expression]))
+
+
+def lookup_models(model, lookup):
+    """Return the set of models (including m2m through models) traversed by a lookup using __ notation"""
+
+    models = set()
+    for field in utils.field_path(model, lookup):
+        if not field.is_relation or field.related_model is None:
+            continue
+        models.add(field.related_model)
+        if field.many_to_many:
+            through = getattr(field, "through", None) or field.remote_field.through
+            models.add(through)
+    return models
+
+
+def queryset_scope(qs):
+    """Return a hashable description of the input queryset or None if it can't be generated"""
+    try:
+        sql, params = qs.query.sql_with_params()
+    except EmptyResultSet:
+        return None
+    return (qs.db, sql, tuple(str(p) for p in params))
+
+
+def generations(models):
+    """Return the current generation tokens for the input models, creating any that are missing"""
+
+    cache = get_cache()
+    keys = sorted(generation_key(m) for m in models)
+    tokens = cache.get_many(keys)
+    for key in keys:
+        if key not in tokens:
+            # add rather than set in case another process just created one
+            cache.add(key, uuid.uuid4().hex, timeout=None)
+            tokens[key] = cache.get(key)
+    return [tokens[key] for key in keys]
+
+
+def make_key(name, scope, models):
+    digest = hashlib.sha1(repr((scope, generations(models))).encode("utf-8")).hexdigest()
+    return "listable:%s:%s" % (name, digest)
+
+
+def queryset_key(name, qs, extra_scope=None, models=()):
+    """
+    Return the cache key for name & the input queryset or None if it can't be
+    cached. The key depends on the models used by the queryset as well as any
+    additional models passed in.
+    """
+
+    scope = queryset_scope(qs)
+    if scope is None:
+        return None
+
+    return make_key(name, (scope, extra_scope), queryset_models(qs) | set(models))
+
+
+def get_or_set(name, qs, default, timeout, extra_scope=None, models=()):
+    """
+    Return the cached value for name & the input queryset, calling default()
+    to calculate (and cache) it when missing.
+    """
+
+    key = queryset_key(name, qs, extra_scope=extra_scope, models=models)
+    if key is None:
+        return default()
+
+    return get_cache().get_or_set(key, default, timeout)
+
+
+def invalidate_model(sender, **kwargs):
+    """Signal receiver invalidating cached values which depend on the sender model"""
+    get_cache().delete(generation_key(sender))
+
+
+def invalidate_m2m(sender, action, **kwargs):
+    """m2m_changed receiver invalidating cached values once the relation has changed"""
+    if action.startswith("post_"):
+        invalidate_model(sender, **kwargs)
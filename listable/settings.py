@@ -14,6 +14,20 @@ LISTABLE_FILTER_DELAY = getattr(settings, "LISTABLE_FILTER_DELAY", 300)
 LISTABLE_LANGUAGE = getattr(settings, "LISTABLE_LANGUAGE", False)
 LISTABLE_ENCODING = getattr(settings, "LISTABLE_ENCODING", "iso-8859-1")
 
+# serializer for ajax responses and the Listable options in the template tag:
+# "auto" (orjson if installed, otherwise json), "orjson", "json" or the dotted
+# path of a callable taking an object and returning str or bytes
+LISTABLE_JSON_ENCODER = getattr(settings, "LISTABLE_JSON_ENCODER", "auto")
+
+# cache used for values cached across requests (see listable.cache)
+LISTABLE_CACHE_ALIAS = getattr(settings, "LISTABLE_CACHE_ALIAS", "default")
+LISTABLE_CACHE_TIMEOUT = getattr(settings, "LISTABLE_CACHE_TIMEOUT", 300)
+# invalidate cached values on post_save/post_delete/m2m_changed signals. None
+# connects the receivers once a view using the cache is defined or used, True
+# connects them at startup (e.g. for processes which write but never import the
+# views) and False disables invalidation
+LISTABLE_CACHE_INVALIDATION = getattr(settings, "LISTABLE_CACHE_INVALIDATION", None)
+
 
 def cookie_name(request, view_name):
     return cookie_prefix(request) + "listable-table-{0}_".format(view_name)
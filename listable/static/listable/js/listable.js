@@ -26,6 +26,114 @@ function listable(moment) {
         return cookieValue;
     }
 
+    // Keyset pagination state: the window requested by the last draw. A cursor
+    // is only sent when moving exactly one page forwards or backwards, anything
+    // else falls back to offset paging.
+    var keyset = {start: null, length: null, state: null};
+
+    function getParam(aoData, name) {
+        for (var i = 0; i < aoData.length; i++) {
+            if (aoData[i].name === name) {
+                return parseInt(aoData[i].value, 10);
+            }
+        }
+        return null;
+    }
+
+    // Select filters for columns in the view's ajax_options start out with only
+    // their selected options. Pages of options are requested from the view when
+    // the dropdown is opened, searched or scrolled to the bottom.
+    function ajaxOptions($select, col) {
+        var state = {search: "", page: 0, more: true, xhr: null};
+        // the multiselect container (button & dropdown) is inserted after the select
+        var $container = $select.next();
+        var $ul = $container.find("ul.multiselect-container");
+
+        function addSearch() {
+            var $search = $('<li class="listable-options-search"><input type="text" class="form-control"/></li>');
+            $search.find("input").val(state.search).attr("placeholder", "Search");
+            $ul.prepend($search);
+            return $search.find("input");
+        }
+
+        function load(reset) {
+            if (reset) {
+                if (state.xhr) {
+                    state.xhr.abort();
+                }
+                state.page = 0;
+                state.more = true;
+            } else if (state.xhr || !state.more) {
+                return;
+            }
+
+            state.xhr = $.getJSON(Listable.url, {
+                iOptionsColumn: col,
+                iOptionsPage: state.page + 1,
+                sOptionsSearch: state.search
+            }, function (json) {
+                var hadFocus = $ul.find(".listable-options-search input").is(":focus");
+
+                if (state.page === 0) {
+                    // keep selected options so the current filter is still shown
+                    $select.find('option:not(:selected):not([value=""])').remove();
+                }
+
+                json.aaOptions.forEach(function (option) {
+                    // match the escaping used by columnFilter when it renders select options
+                    var value = escape(option.value);
+                    var exists = $select.find("option").filter(function () {
+                        return this.value === value;
+                    }).length;
+                    if (!exists) {
+                        $select.append('<option value="' + value + '">' + option.label + '</option>');
+                    }
+                });
+
+                state.page += 1;
+                state.more = json.bMore;
+                state.xhr = null;
+
+                var scrollTop = $ul.scrollTop();
+                $select.multiselect("rebuild");
+                var $input = addSearch();
+                $ul.scrollTop(scrollTop);
+                if (hadFocus) {
+                    $input.focus();
+                }
+            });
+        }
+
+        addSearch();
+
+        var timeout = null;
+        $ul.on("click", ".listable-options-search", function (event) {
+            event.stopPropagation();
+        }).on("keydown", ".listable-options-search input", function (event) {
+            // don't submit forms or toggle the dropdown
+            if (event.which === 13) {
+                event.preventDefault();
+            }
+        }).on("input", ".listable-options-search input", function () {
+            var search = this.value;
+            clearTimeout(timeout);
+            timeout = setTimeout(function () {
+                state.search = search;
+                load(true);
+            }, Listable.filteringDelay || 0);
+        }).on("scroll", function () {
+            if ($ul.scrollTop() + $ul.innerHeight() >= this.scrollHeight - 20) {
+                load(false);
+            }
+        });
+
+        $container.on("shown.bs.dropdown", function () {
+            if (state.page === 0) {
+                load(true);
+            }
+        });
+    }
+
     var table = $(Listable.tableId).addClass(
         Listable.cssTableClass
     ).dataTable({
@@ -43,7 +151,62 @@ function listable(moment) {
         bFilter: true,
         sDom: Listable.DOM,
         sCookiePrefix: Listable.cookiePrefix,
-        oLanguage: Listable.language
+        oLanguage: Listable.language,
+        fnServerParams: function (aoData) {
+            if (!Listable.keysetPagination) {
+                return;
+            }
+
+            // Like the live filters below, the response to the previous draw
+            // is read from the jqXHR object stored on the settings.
+            var settings = this.fnSettings();
+            var last = settings.jqXHR && settings.jqXHR.responseJSON;
+            var start = getParam(aoData, "iDisplayStart");
+            var length = getParam(aoData, "iDisplayLength");
+            var cursor = null;
+
+            // cursors are only valid for the filters & sorting they were
+            // created with so a filter or sort draw starts afresh
+            var state = $.map(aoData, function (param) {
+                return /^(sSearch|iSortCol_|sSortDir_|iSortingCols)/.test(param.name) ? param.name + "=" + param.value : null;
+            }).join("&");
+            if (state !== keyset.state) {
+                keyset.start = null;
+            }
+
+            if (last && length === keyset.length && keyset.start !== null) {
+                if (start === keyset.start + length) {
+                    cursor = last.sNextCursor;
+                } else if (start === keyset.start - length) {
+                    cursor = last.sPrevCursor;
+                }
+            }
+
+            if (cursor) {
+                aoData.push({name: "sCursor", value: cursor});
+            }
+
+            keyset.start = start;
+            keyset.length = length;
+            keyset.state = state;
+        },
+        fnInfoCallback: function (oSettings, iStart, iEnd, iMax, iTotal, sPre) {
+            var json = oSettings.jqXHR && oSettings.jqXHR.responseJSON;
+            if (!json || (json.sCountType !== "estimate" && json.sCountType !== "capped")) {
+                return sPre;
+            }
+
+            // replace the last occurrence of the total with "about N" for
+            // estimates or "N+" for capped counts (which are reported as cap + 1)
+            var total = oSettings.fnFormatNumber(iTotal);
+            var idx = sPre.lastIndexOf(total);
+            if (idx < 0) {
+                return sPre;
+            }
+
+            var display = json.sCountType === "estimate" ? "about " + total : oSettings.fnFormatNumber(iTotal - 1) + "+";
+            return sPre.substring(0, idx) + display + sPre.substring(idx + total.length);
+        }
     }).columnFilter({
         sPlaceHolder: "head:after",
         aoColumns: Listable.columnFilterDefs,
@@ -116,6 +279,11 @@ function listable(moment) {
                     var select = $("thead > tr > th:nth-child(" + c + ") select");
                     for (var j in searchers) {
                         var option = $(select).children("option[value='" + searchers[j] + "']");
+                        if (!option.length && Listable.columnFilterDefs[i] && Listable.columnFilterDefs[i].ajaxOptions) {
+                            // ajax options are not in the page so add the saved selection
+                            option = $('<option/>').attr('value', searchers[j]).html(unescape(searchers[j]));
+                            $(select).append(option);
+                        }
                         $(option).attr('selected', 'selected');
                     }
                 }
@@ -282,6 +450,9 @@ function listable(moment) {
                 } else {
                     $(select).attr('multiple', false).multiselect({});
                 }
+                if (Listable.columnFilterDefs[col].ajaxOptions) {
+                    ajaxOptions($(select), col);
+                }
                 // $(select).multiselect();
             }
             else if (Listable.columnFilterDefs[col].type == 'daterange') {
@@ -369,6 +540,16 @@ function listable(moment) {
         }
     }
 
+    // Links & buttons with a data-listable-export="csv|ndjson|xlsx" attribute
+    // download the table with the current filters and sort order applied.
+    $(document).on("click", "[data-listable-export]", function (event) {
+        event.preventDefault();
+        var settings = table.fnSettings();
+        var aoData = table.oApi._fnAjaxParameters(settings);
+        aoData.push({name: "sExport", value: $(this).data("listable-export")});
+        window.location = Listable.url + (Listable.url.indexOf("?") < 0 ? "?" : "&") + $.param(aoData);
+    });
+
     $(table).find("input:not(:checkbox, :radio), select, button").addClass(
         Listable.cssInputClass
     );
@@ -1,12 +1,10 @@
-import json
-
 from django import template
 from django.templatetags.static import static
 from django.urls import reverse
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
-from .. import settings, utils
+from .. import cache, settings, utils
 from ..views import (
     DATE,
     DATE_RANGE,
@@ -59,8 +57,38 @@ def listable_js():  #pragma: nocover
     return mark_safe('\n'.join(get_listable_scripts()))
 
 
-def values_to_dt(values):
-    return [{"value": str(escape(x[0])), "label": escape(str(x[1]))} for x in utils.unique(values)]
+def get_select_values(view_instance, field, queryset, view_name, view_args=None, view_kwargs=None):
+    """Return the DataTables select values for field, cached if the view has cache_filter_options set"""
+
+    def get_values():
+        return utils.values_to_dt(view_instance.get_filters(field, queryset=queryset))
+
+    if not view_instance.cache_filter_options:
+        return get_values()
+
+    scope = (
+        view_name,
+        tuple(view_args or ()),
+        tuple(sorted((view_kwargs or {}).items())),
+        view_instance.get_cache_scope(),
+    )
+
+    return cache.get_or_set(
+        view_instance.get_cache_name("filters.%s" % field),
+        queryset,
+        get_values,
+        view_instance.cache_timeout,
+        extra_scope=scope,
+        models=view_instance.get_column_models(queryset.model, field),
+    )
+
+
+def select_filter_def(values, **kwargs):
+    """Return the columnFilter definition for a select filter. values of None means options are loaded by ajax"""
+
+    if values is None:
+        return dict({'type': 'select', 'values': [], 'ajaxOptions': True}, **kwargs)
+    return dict({'type': 'select', 'values': values}, **kwargs)
 
 
 @register.filter(name="header")
@@ -149,11 +177,14 @@ def get_options(context, view_name, dom="", save_state=None, pagination_type="",
 
                 if is_local and choices:
                     # local field with choices defined
-                    values = values_to_dt(choices)
+                    values = utils.values_to_dt(choices)
+                elif field in cls.ajax_options:
+                    # options are loaded on demand by listable.js
+                    values = None
                 else:
-                    values = values_to_dt(view_instance.get_filters(field, queryset=qs))
+                    values = get_select_values(view_instance, field, qs, view_name, view_args, view_kwargs)
 
-                column_filter_defs.append({'type': 'select', 'values': values, 'label': '-----'})
+                column_filter_defs.append(select_filter_def(values, label='-----'))
                 column_search.append({'sSearch': escape(init_search), 'bRegex': False})
 
             elif widget_type in [SELECT_MULTI, SELECT_MULTI_FROM_MULTI]:
@@ -162,10 +193,12 @@ def get_options(context, view_name, dom="", save_state=None, pagination_type="",
 
                 if is_local and choices:
                     # local field with choices defined
-                    values = values_to_dt(choices)
+                    values = utils.values_to_dt(choices)
+                elif field in cls.ajax_options:
+                    values = None
                 else:
-                    values = values_to_dt(view_instance.get_filters(field, queryset=qs))
-                column_filter_defs.append({'type': 'select', 'values': values, 'multiple': 'multiple'})
+                    values = get_select_values(view_instance, field, qs, view_name, view_args, view_kwargs)
+                column_filter_defs.append(select_filter_def(values, multiple='multiple'))
                 column_search.append({'sSearch': escape(init_search), 'bRegex': True})
 
             elif widget_type == DATE_RANGE:
@@ -206,6 +239,7 @@ def get_options(context, view_name, dom="", save_state=None, pagination_type="",
         "cookiePrefix": settings.cookie_prefix(context['request']),
         "filteringDelay": cls.filter_delay,
         "liveFilters": cls.live_filters,
+        "keysetPagination": cls.keyset_pagination,
     }
 
     if settings.LISTABLE_LANGUAGE:
@@ -223,7 +257,7 @@ def listable(context, view_name, dom="", save_state=None, pagination_type="", cs
 
     opts = get_options(context, view_name, dom, save_state, pagination_type, css_table_class, css_input_class, auto_width)
 
-    scripts = ['<script type="text/javascript">var Listable = {0};</script>'.format(json.dumps(opts))]
+    scripts = ['<script type="text/javascript">var Listable = {0};</script>'.format(utils.json_dumps(opts))]
     if not requirejs:
         scripts += get_listable_scripts()
         scripts += ['<script src="{0}" type="text/javascript"></script>'.format(static('listable/js/listable.js'))]
@@ -1,10 +1,26 @@
+import base64
+import datetime
+import decimal
 import importlib
+import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import unquote
 
+from django.apps import apps
+from django.core.exceptions import EmptyResultSet, FieldDoesNotExist, ImproperlyConfigured
+from django.db import close_old_connections, connections
 from django.urls import reverse, resolve, get_script_prefix
+from django.utils import timezone
+from django.utils.encoding import force_str
+from django.utils.functional import Promise
+from django.utils.html import escape
+from django.utils.module_loading import import_string
 import django.db.models.fields
 
+from . import settings as li_settings
+
 BOOL_TYPE = django.db.models.fields.BooleanField().get_internal_type()
 
 
@@ -14,6 +30,11 @@ def unique(seq):
     return [x for x in seq if x not in seen and not seen_add(x)]
 
 
+def values_to_dt(values):
+    """Convert (value, label) pairs to the option format used by DataTables select filters"""
+    return [{"value": str(escape(x[0])), "label": escape(str(x[1]))} for x in unique(values)]
+
+
 def lookup_dunder_prop(obj, props, multi=False):
     """
     Take an obj and lookup the value of a related attribute
@@ -33,6 +54,214 @@ def lookup_dunder_prop(obj, props, multi=False):
         return None
 
 
+def field_path(model, lookup):
+    """
+    Return the list of model fields traversed by a lookup using __ notation.
+
+    Walking stops at the first part that is not a field (e.g. a lookup like
+    icontains) so field_path(Staff, "department__name__icontains") returns
+    [Staff.department, Department.name].
+    """
+    fields = []
+    for part in lookup.split("__"):
+        if model is None:
+            break
+        try:
+            field = model._meta.pk if part == "pk" else model._meta.get_field(part)
+        except FieldDoesNotExist:
+            break
+        fields.append(field)
+        model = field.related_model if field.is_relation else None
+    return fields
+
+
+def generic_lookup(model, lookup):
+    """
+    Return (GenericForeignKey, remaining lookup) if lookup traverses a
+    GenericForeignKey of model (e.g. "generic_object__name") otherwise None.
+    """
+
+    head, __, tail = lookup.partition("__")
+    if not tail or not apps.is_installed("django.contrib.contenttypes"):
+        return None
+
+    from django.contrib.contenttypes.fields import GenericForeignKey
+
+    try:
+        field = model._meta.get_field(head)
+    except FieldDoesNotExist:
+        return None
+
+    if not isinstance(field, GenericForeignKey):
+        return None
+
+    return field, tail
+
+
+def _json_default(value):
+    # e.g. lazy translations in the template tag options
+    if isinstance(value, Promise):
+        return force_str(value)
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+def _orjson_dumps(value):
+    import orjson
+    return orjson.dumps(value, default=_json_default)
+
+
+def _stdlib_dumps(value):
+    return json.dumps(value, default=_json_default)
+
+
+_json_encoders = {}
+
+
+def get_json_encoder(name):
+    """Return the serializer callable for a LISTABLE_JSON_ENCODER value"""
+
+    if name not in _json_encoders:
+        if name == "auto":
+            try:
+                import orjson  # noqa: F401
+                encoder = _orjson_dumps
+            except ImportError:
+                encoder = _stdlib_dumps
+        elif name == "orjson":
+            try:
+                import orjson  # noqa: F401
+            except ImportError:
+                raise ImproperlyConfigured("LISTABLE_JSON_ENCODER is 'orjson' but orjson is not installed")
+            encoder = _orjson_dumps
+        elif name == "json":
+            encoder = _stdlib_dumps
+        else:
+            try:
+                encoder = import_string(name)
+            except ImportError as e:
+                raise ImproperlyConfigured("Invalid LISTABLE_JSON_ENCODER %r: %s" % (name, e))
+        _json_encoders[name] = encoder
+
+    return _json_encoders[name]
+
+
+def json_dumps(value):
+    """Serialize value to a JSON str with the LISTABLE_JSON_ENCODER serializer"""
+    return force_str(get_json_encoder(li_settings.LISTABLE_JSON_ENCODER)(value))
+
+
+_query_executors = {}
+_query_executors_lock = threading.Lock()
+
+
+def get_query_executor(max_workers):
+    """Return the shared ThreadPoolExecutor with max_workers threads used for running queries concurrently"""
+
+    with _query_executors_lock:
+        if max_workers not in _query_executors:
+            _query_executors[max_workers] = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="listable-query",
+            )
+        return _query_executors[max_workers]
+
+
+def run_query(func, *args):
+    """
+    Call func(*args) in a query executor thread. Each thread has its own
+    database connections which are closed afterwards (or kept according to
+    CONN_MAX_AGE) the same way as at the end of a request.
+    """
+
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def aiter_sync(iterable):
+    """
+    Asynchronously iterate a sync iterable, e.g. streaming response content,
+    pulling one item at a time in a (thread sensitive) thread.
+    """
+
+    from asgiref.sync import sync_to_async
+
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = await sync_to_async(next)(iterator, done)
+        if item is done:
+            break
+        yield item
+
+
+class EchoBuffer:
+    """File like object returning what is written, for streaming csv.writer output"""
+
+    def write(self, value):
+        return value
+
+
+def excel_value(value):
+    """Convert a cell value to a type openpyxl can write"""
+
+    if isinstance(value, datetime.datetime) and timezone.is_aware(value):
+        # Excel has no time zone support
+        return timezone.make_naive(value)
+    if value is None or isinstance(value, (bool, int, float, decimal.Decimal, datetime.date, datetime.time)):
+        return value
+    return force_str(value)
+
+
+def _cursor_default(value):
+    # isoformat keeps microseconds (DjangoJSONEncoder truncates them) which
+    # matters since cursor values are compared for equality in the database
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def encode_cursor(data):
+    """Encode a JSON serializable cursor payload as a url safe string"""
+    return base64.urlsafe_b64encode(json.dumps(data, default=_cursor_default).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decode a cursor created by encode_cursor. Returns None for invalid cursors"""
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError):
+        return None
+
+
+def estimate_count(qs):
+    """
+    Return the query planner's estimate of the number of rows the input
+    queryset returns or None if the database doesn't provide one. Currently
+    only PostgreSQL exposes a row estimate (SQLite's EXPLAIN QUERY PLAN does
+    not include one).
+    """
+
+    connection = connections[qs.db]
+    if connection.vendor != "postgresql":
+        return None
+
+    try:
+        sql, params = qs.order_by().query.get_compiler(using=qs.db).as_sql()
+    except EmptyResultSet:
+        return 0
+
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 def class_for_view_name(view_name, args=None, kwargs=None):
     """ return View class for input view_name
     see http://stackoverflow.com/a/21313506/79802
@@ -1,22 +1,59 @@
+import asyncio
+import csv
 import datetime
+import hashlib
 import json
+import tempfile
 import typing
 from functools import reduce
+from itertools import islice
 from html import unescape
-
-from django.db.models import F, Q, QuerySet
-from django.core.exceptions import FieldDoesNotExist
+import inspect
+import re
+from operator import attrgetter, methodcaller
+from types import MappingProxyType
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import (
+    Case,
+    CharField,
+    Count,
+    Exists,
+    F,
+    IntegerField,
+    Max,
+    Min,
+    OuterRef,
+    Prefetch,
+    Q,
+    QuerySet,
+    Subquery,
+    Value,
+    When,
+    Window,
+    prefetch_related_objects,
+)
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
+from django.core.exceptions import FieldDoesNotExist, FieldError, ImproperlyConfigured, ValidationError
+from django.core.paginator import Paginator
+import django
 import django.db.models.fields
-from django.http import Http404, HttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.template.loader import get_template
 from django.urls import resolve
 from django.utils import formats, timezone
+from django.utils.encoding import force_str
+from django.utils.hashable import make_hashable
 from django.utils.html import escape, conditional_escape
 from django.utils.text import smart_split
 from django.utils.translation import gettext as _
 from django.views.generic import ListView
 import six
 
+from . import cache as li_cache
 from . import settings as li_settings
 from . import utils
 
@@ -61,6 +98,26 @@ NEXT_YEAR = "Next Year"
 
 NONEORNULL = 'noneornull'
 
+NEXT = "next"
+PREV = "prev"
+
+COUNT_EXACT = "exact"
+COUNT_ESTIMATE = "estimate"
+COUNT_HYBRID = "hybrid"
+COUNT_CAPPED = "capped"
+COUNT_WINDOW = "window"
+
+EXPORT_CSV = "csv"
+EXPORT_NDJSON = "ndjson"
+EXPORT_XLSX = "xlsx"
+
+
+class CachedLiveFilters(typing.NamedTuple):
+    """Live filter values found in the cache and the columns still to be queried"""
+    values: dict
+    cache_keys: dict
+    missing: list
+
 
 class QuerysetFilters(typing.NamedTuple):
     """Keep track of filters to apply to a queryset and whether to apply distinct"""
@@ -68,6 +125,87 @@ class QuerysetFilters(typing.NamedTuple):
     distinct: bool
 
 
+class RecordCount(typing.NamedTuple):
+    """
+    A record count and whether it is exact (COUNT_EXACT), an estimate
+    (COUNT_ESTIMATE) or a lower bound (COUNT_CAPPED).
+    """
+    count: int
+    count_type: str = COUNT_EXACT
+
+
+# renderer kinds for compiled column plans (see BaseListableView.compile_column)
+RENDER_BATCH = "batch"
+RENDER_FORMATTER = "formatter"
+RENDER_CONSTANT = "constant"
+RENDER_RELATED = "related"
+RENDER_GENERIC = "generic"
+RENDER_CHOICES = "choices"
+RENDER_DISPLAY = "display"
+RENDER_ATTR = "attr"
+
+
+class ColumnPlan(typing.NamedTuple):
+    """How to render the cells of a single column, compiled once per view class & model"""
+    field: str
+    kind: str
+    path: tuple = ()
+    choices: typing.Optional[typing.Mapping] = None
+    multi: bool = False
+    # whether the column can be fetched with values_list (see values_projection)
+    projectable: bool = False
+
+
+class QueryFields(typing.NamedTuple):
+    """select_related paths & only() fields (None for all fields) inferred from a views columns"""
+    select_related: list
+    only: typing.Optional[list]
+
+
+class ProjectedRow:
+    """A row of values fetched with values_list() used in place of a model instance"""
+
+    def __init__(self, names, values):
+        self.__dict__.update(zip(names, values))
+
+
+def format_attr(attr):
+    """Default formatting of a model attribute for display in a cell"""
+
+    if callable(attr):
+        return attr()
+    elif isinstance(attr, datetime.datetime):
+        return formats.date_format(attr, "SHORT_DATETIME_FORMAT")
+    elif isinstance(attr, datetime.date):
+        return formats.date_format(attr, "SHORT_DATE_FORMAT")
+    elif isinstance(attr, six.string_types):
+        attr.encode("UTF-8")
+    elif attr is None:
+        return ""
+
+    return "%s" % attr
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for use with an estimated or capped count. Pages are never
+    rejected or truncated based on the count since the real number of records
+    may be higher than the count.
+    """
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return super().validate_number(number)
+        return max(number, 1)
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        return self._get_page(self.object_list[bottom:bottom + self.per_page], number, self)
+
+
 class BaseListableView(ListView):
 
     fields = ()
@@ -100,6 +238,11 @@ class BaseListableView(ListView):
     # Example: static_live_filters = {"is_active": ["True", "False"]}
     static_live_filters = {}
 
+    # Compute the options for all live filter columns with a single UNION ALL
+    # query (one tagged DISTINCT subquery per column) instead of one query per
+    # column.
+    live_filters_union = False
+
     headers = {}
 
     multi_separator = ', '
@@ -112,7 +255,146 @@ class BaseListableView(ListView):
 
     order_by = ()
 
-    defer = True
+    # Keyset (a.k.a. seek) pagination. When enabled, the JSON response includes
+    # `sNextCursor` and `sPrevCursor` values built from the current ordering
+    # (plus a pk tiebreaker) and listable.js sends them back as `sCursor` when
+    # moving to the next/previous page. The page is then fetched with a
+    # WHERE clause on the ordering values instead of an OFFSET, so deep pages
+    # are as cheap as the first one. Jumping to an arbitrary page, or ordering
+    # on something that can't be used as a key (expressions, nullable or
+    # related/multi valued fields, extra selects), falls back to OFFSET paging.
+    keyset_pagination = False
+
+    # SELECT_MULTI selections with at least this many values are compared to the
+    # distinct values of the column first: selecting every value removes the
+    # filter, a smaller set of unselected values is filtered with NOT IN and
+    # otherwise the values are bound as a single parameter (a JSON array on
+    # SQLite, an array on PostgreSQL) rather than one parameter per value.
+    large_selection_threshold = 100
+
+    # Filters traversing a many-to-many or reverse foreign key match a row once
+    # per related row and by default the filtered querysets are made distinct.
+    # When exists_filters is enabled these filters are instead applied as a
+    # correlated EXISTS subquery so every row is matched at most once and the
+    # count, page & live filter queries don't need a DISTINCT.
+    exists_filters = False
+
+    # Deferred join ("late row lookup") paging. When enabled the page query
+    # only selects primary keys from the filtered & ordered queryset (without
+    # select_related joins) and the full rows for that page are then loaded by
+    # pk with select_related/prefetch_related applied. This avoids the database
+    # sorting and skipping over wide, fully joined rows for large offsets.
+    deferred_join = False
+
+    # Cache the unfiltered record count (iTotalRecords) across requests. The
+    # cache key includes the view class and the SQL of the unfiltered queryset
+    # (so per user get_queryset filtering is respected) and cached counts are
+    # invalidated when any model used by the queryset is saved or deleted.
+    cache_total_count = False
+
+    # Cache live filter values across requests. Values are cached per column
+    # and keyed on the SQL of the column's live filter queryset, i.e. the
+    # base queryset plus the filters on all other columns, so paging and
+    # sorting don't require any live filter queries. Invalidated like
+    # cache_total_count.
+    cache_live_filters = False
+
+    # Cache the options for SELECT/SELECT_MULTI columns generated by the
+    # listable template tag. Keyed on the view name, args & kwargs, the SQL of
+    # get_queryset and get_cache_scope and invalidated like cache_total_count.
+    cache_filter_options = False
+
+    # Fetch page rows with values_list() rather than model instances when
+    # every column is a model field path (using __ notation for related
+    # fields), a field with choices, an extra select/annotation or a constant.
+    # Falls back to model instances when any column needs a formatter or
+    # model method.
+    values_projection = False
+
+    # Stream the ajax response for pages of at least streaming_page_size rows
+    # (or all rows when DataTables requests iDisplayLength=-1). Rows are read
+    # from the database with .iterator(chunk_size=streaming_chunk_size) and
+    # formatted & written a chunk at a time so memory use doesn't grow with
+    # the page size. Keyset pagination pages are never streamed.
+    streaming = False
+    streaming_page_size = 1000
+    streaming_chunk_size = 2000
+
+    # Formats (EXPORT_CSV, EXPORT_NDJSON and/or EXPORT_XLSX) the table can be
+    # downloaded in by adding sExport=<format> to the view's url. Exports
+    # contain every row matching the current filters & sort order (including
+    # the sticky cookie state) and are streamed in chunks of
+    # streaming_chunk_size rows. XLSX exports require openpyxl.
+    export_formats = ()
+
+    # Number of threads used to run the filtered count, unfiltered count, page
+    # and live filter queries of ajax requests concurrently, each thread using
+    # its own database connection, so the response time is set by the slowest
+    # query rather than their sum. The thread pool is shared by every view
+    # with the same concurrent_queries. Queries run one after another as
+    # usual inside a transaction (e.g. ATOMIC_REQUESTS) since other
+    # connections can't see its changes, and for keyset or COUNT_WINDOW
+    # pages. 0 disables the thread pool.
+    concurrent_queries = 0
+
+    # Computed columns as a dict of column name -> Django expression, e.g.
+    # {"full_name": Concat("first_name", Value(" "), "last_name")}. They are
+    # added to the queryset with annotate() so they can be displayed,
+    # filtered, sorted and counted by the ORM like any other field. Override
+    # get_annotations for expressions that need to be built per request.
+    annotations = {}
+
+    # Columns traversing a GenericForeignKey (e.g. "generic_object__name") are
+    # displayed by fetching the related objects for a page with one query per
+    # content type and filtered & sorted using a CASE of subqueries per content
+    # type. generic_models maps a GenericForeignKey name to the models it can
+    # point at. By default these are the content types allowed by the
+    # limit_choices_to of the content type field or otherwise all content
+    # types in use in the table, cached for cache_timeout seconds.
+    generic_models = {}
+
+    # SELECT/SELECT_MULTI columns whose options are not embedded in the page
+    # but loaded on demand (searched & paginated) by ajax requests to the view.
+    # Use for columns with a large number of distinct values.
+    ajax_options = ()
+
+    # number of options returned per ajax options request
+    ajax_options_page_size = 50
+
+    # Timeout (in seconds) for values cached across requests
+    cache_timeout = li_settings.LISTABLE_CACHE_TIMEOUT
+
+    # How the number of records matching the filters (iTotalDisplayRecords) is
+    # counted. One of:
+    #   COUNT_EXACT: a COUNT(*) of the filtered queryset (default)
+    #   COUNT_ESTIMATE: the query planner's row estimate (falls back to an exact
+    #       count when the database does not provide one, e.g. SQLite)
+    #   COUNT_HYBRID: an exact count when the estimate is below
+    #       count_estimate_threshold, otherwise the estimate
+    #   COUNT_CAPPED: count at most count_cap rows (or up to the end of the
+    #       requested page if that is further). When there are more rows the
+    #       count is reported as cap + 1, i.e. a lower bound
+    #   COUNT_WINDOW: annotate the page query with COUNT(*) OVER () so the
+    #       count is fetched along with the page in a single query. Falls back
+    #       to COUNT_EXACT for empty pages, get_extra, union and distinct
+    #       querysets and databases without window function support
+    # The JSON response includes `sCountType` so listable.js can show
+    # estimated counts as "about N" and capped counts as "N+".
+    count_strategy = COUNT_EXACT
+    count_estimate_threshold = 100000
+    count_cap = 10000
+
+    # Infer the select_related paths and the only() fields required to
+    # render the table from `fields` so the page query reads only the columns
+    # that are displayed. Columns rendered by a formatter (or a model
+    # get_<field>_display/method) are loaded using the fields from their
+    # order_fields & search_fields entries unless listed in defer_fields.
+    defer = False
+
+    # Mapping of column -> the field paths its formatter needs, e.g.
+    # {"name": ("first_name", "last_name")}. None disables only() for tables
+    # including that column.
+    defer_fields = {}
 
     def __init__(self, *args, **kwargs):
         super(BaseListableView, self).__init__(**kwargs)
@@ -121,6 +403,10 @@ class BaseListableView(ListView):
         if not isinstance(filtering, basestring):
             return True
 
+        if any(filtering == name or filtering.startswith(name + "__") for name in qs.query.annotations):
+            # computed columns are a single value per row
+            return False
+
         model = qs.model
         parts = filtering.split("__")
         for part in parts:
@@ -140,30 +426,87 @@ class BaseListableView(ListView):
 
         return False
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.uses_cache():
+            li_cache.connect_invalidation()
+
+    @classmethod
+    def uses_cache(cls):
+        """Whether the view caches any values across requests"""
+        return bool(cls.cache_total_count or cls.cache_live_filters or cls.cache_filter_options)
+
     def get(self, request, *args, **kwargs):
         """
         return regular list view on page load and then json data on
         datatables ajax request.
         """
 
-        for field in self.get_fields(request=request):
-            if field not in self.widgets:
-                if field in self.search_fields and not self.search_fields[field]:
-                    self.widgets[field] = None
-                else:
-                    self.widgets[field] = TEXT
+        self.init_table()
+
+        is_ajax = self.request.headers.get('x-requested-with') == 'XMLHttpRequest'
+        export_format = self.request.GET.get("sExport")
+        if not is_ajax and not export_format:
+            return super(BaseListableView, self).get(request, *args, **kwargs)
+
+        if export_format and export_format not in self.export_formats:
+            raise Http404(_("Invalid export format"))
+
+        if "iOptionsColumn" in self.request.GET:
+            context = self.get_ajax_options_context_data()
+            return HttpResponse(utils.json_dumps(context), content_type='application/json')
+
+        self.prepare_table(export_format)
+
+        if export_format:
+            return self.get_export_response(export_format)
+
+        allow_empty = self.get_allow_empty()
+
+        if not allow_empty:
+            # When pagination is enabled and object_list is a queryset,
+            # it's better to do a cheap query than to load the unpaginated
+            # queryset in memory.
+            if (self.get_paginate_by(self.object_list) is not None and
+                    hasattr(self.object_list, 'exists')):
+                is_empty = not self.object_list.exists()
+            else:
+                is_empty = len(self.object_list) == 0
+            if is_empty:
+                raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.").format(class_name=self.__class__.__name__))
+
+        if self.should_stream():
+            return self.get_streaming_response()
+
+        context = self.get_table_context_data(object_list=self.object_list)
+        return HttpResponse(utils.json_dumps(context), content_type='application/json')
+
+    def init_table(self):
+        """Reset the per request state and set object_list to get_queryset()"""
 
         self.search_filters = {}
+        self._keyset_keys = None
+        self._count_queryset = None
+        self._record_count = None
+        self._deferred_queryset = None
+        self._projection_model = None
+        self._unfiltered_queryset = None
+        self._unfiltered_count = None
 
         # below adapted from Django list view code
         self.object_list = self.get_queryset()
 
-        is_ajax = self.request.headers.get('x-requested-with') == 'XMLHttpRequest'
-        if not is_ajax:
-            return super(BaseListableView, self).get(request, *args, **kwargs)
+    def prepare_table(self, export_format=None):
+        """
+        Apply the requested (or sticky cookie) filters and ordering to
+        object_list and set up the count & deferred querysets. No rows are
+        fetched here.
+        """
 
         self.set_query_params()
 
+        self.object_list = self.annotate_queryset(self.object_list)
+
         self.extra = self.get_extra()
         if self.extra:
             self.object_list = self.object_list.extra(**self.extra)
@@ -184,121 +527,785 @@ class BaseListableView(ListView):
 
         self.object_list = self.order_queryset(self.object_list)
 
-        if self.select_related:
-            self.object_list = self.object_list.select_related(*self.select_related)
+        if self.keyset_pagination and not has_union and not export_format:
+            self.object_list = self.keyset_queryset(self.object_list)
+
+        if self.deferred_join and not has_union:
+            # Page queries only select primary keys from the narrow queryset and the
+            # full rows are loaded separately with related objects (see get_page_objects)
+            self._deferred_queryset = self.related_queryset(self.object_list.order_by())
+        else:
+            self.object_list = self.related_queryset(self.object_list)
 
-        if self.prefetch_related:
-            self.object_list = self.object_list.prefetch_related(*self.prefetch_related)
+    def get_table_context_data(self, **kwargs):
+        """ Context data for datatables ajax request """
 
-        # Some Django backends can choke when paginating a query
-        # that has an extra clause on it (the count() call fails)
-        # so we can patch on our own count function that first tries the
-        # native count method and then falls back on a query that uses a single
-        # db call and if all else fails just iterate the queryset and count it.
-        # Not ideal but it seems to work.
-        if self.extra:
-            def make_count(qs):
-                orig_count = qs.count
+        queryset = kwargs.get("object_list", self.object_list)
 
-                def count():
-                    try:
-                        # works ok on mssql
-                        return orig_count()
-                    except Exception:
-                        try:
-                            from django.db import connection
-                            cursor = connection.cursor()
-                            sql, params = qs.query.sql_with_params()
-                            count_sql = "SELECT COUNT(*) FROM ({0})".format(sql)
-                            cursor.execute(count_sql, params)
-                            return cursor.fetchone()[0]
-                        except Exception:
-                            # fall back to iterating and counting :(
-                            return len(_ for x in qs.values_list("pk"))
-                return count
-
-            self.object_list.count = make_count(self.object_list)
-            self._count_queryset.count = make_count(self._count_queryset)
-            if hasattr(self, "_unfiltered_count"):
-                self._unfiltered_count.count = make_count(self._unfiltered_count)
-                self._unfiltered_count = self._unfiltered_count.count()
-        elif hasattr(self, "_unfiltered_count"):
-            self._unfiltered_count = self._unfiltered_count.count()
+        if self.should_query_concurrently(queryset):
+            return self.get_concurrent_table_context_data(queryset)
 
-        allow_empty = self.get_allow_empty()
+        page = None
+        if self._keyset_keys:
+            page = self.get_keyset_page(queryset)
+        if page is None and self.count_strategy == COUNT_WINDOW:
+            page = self.get_window_page(queryset)
 
-        if not allow_empty:
-            # When pagination is enabled and object_list is a queryset,
-            # it's better to do a cheap query than to load the unpaginated
-            # queryset in memory.
-            if (self.get_paginate_by(self.object_list) is not None and
-                    hasattr(self.object_list, 'exists')):
-                is_empty = not self.object_list.exists()
+        if page is not None:
+            object_list, has_previous, has_next = page
+            record_count = self.get_record_count()
+        else:
+            self.set_page()
+
+            context = super(BaseListableView, self).get_context_data(**kwargs)
+
+            object_list = context["object_list"]
+
+            # the paginator gets its count from get_record_count (see get_paginator)
+            record_count = self.get_record_count()
+            if isinstance(object_list, QuerySet):
+                object_list = self.get_page_objects(object_list)
+
+            if "paginator" in context and context["paginator"] is not None:
+                has_previous = context["page_obj"].has_previous()
+                has_next = context["page_obj"].has_next()
             else:
-                is_empty = len(self.object_list) == 0
-            if is_empty:
-                raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.").format(class_name=self.__class__.__name__))
+                has_previous = has_next = False
 
-        context = self.get_table_context_data(object_list=self.object_list)
-        return HttpResponse(json.dumps(context), content_type='application/json')
+        context = self.get_table_info(record_count)
+        context["aaData"] = self.get_rows(object_list)
 
-    def get_table_context_data(self, **kwargs):
-        """ Context data for datatables ajax request """
-        self.set_page()
+        if self._keyset_keys:
+            object_list = list(object_list)
+            context["sPrevCursor"] = self.get_cursor(object_list[0], PREV) if object_list and has_previous else None
+            context["sNextCursor"] = self.get_cursor(object_list[-1], NEXT) if object_list and has_next else None
 
-        context = super(BaseListableView, self).get_context_data(**kwargs)
+        if self.live_filters:
+            context["liveFilters"] = self.get_live_filters()
+
+        return context
 
-        object_list = context["object_list"]
+    def should_query_concurrently(self, queryset):
+        """Whether to run the queries of the current ajax request in a thread pool (see concurrent_queries)"""
+
+        if not self.concurrent_queries or self._keyset_keys or self.count_strategy == COUNT_WINDOW:
+            return False
+
+        if not isinstance(queryset, QuerySet) or self.get_paginate_by(queryset) <= 0:
+            return False
+
+        # other connections can't see the changes made in an open transaction
+        return not connections[queryset.db].in_atomic_block
+
+    def get_concurrent_table_context_data(self, queryset):
+        """
+        Context data for datatables ajax request with the filtered count,
+        unfiltered count, page and live filter queries run concurrently in the
+        concurrent_queries thread pool.
+        """
+
+        page_size = self.get_paginate_by(queryset)
+        offset = self.get_page_offset(page_size)
+        page_qs = queryset[offset:offset + page_size]
+
+        executor = utils.get_query_executor(self.concurrent_queries)
+        record_count = executor.submit(utils.run_query, self.get_record_count)
+        total_records = executor.submit(utils.run_query, self.get_total_records)
+        page = executor.submit(utils.run_query, self.get_page_objects, page_qs)
+
+        live_filter_values = []
+        if self.live_filters:
+            cached = self.get_cached_live_filters()
+            if self.live_filters_union:
+                live_filter_values.append(executor.submit(utils.run_query, self.get_live_filter_values_union, cached.missing))
+            else:
+                live_filter_values.extend(
+                    executor.submit(utils.run_query, self.get_live_filters_values, [field]) for field in cached.missing
+                )
+
+        object_list = page.result()
+        self.check_page_exists(object_list, offset, page_size)
+
+        total_records.result()
+        context = self.get_table_info(record_count.result())
+        context["aaData"] = self.get_rows(object_list)
+
+        if self.live_filters:
+            missing_values = {}
+            for values in live_filter_values:
+                missing_values.update(values.result())
+            context["liveFilters"] = self.format_live_filters(cached, missing_values)
+
+        return context
+
+    def get_table_info(self, record_count):
+        """The record counts & echo for a datatables ajax response"""
 
         try:
             secho = int(self.search_filters.get("sEcho"))
         except (TypeError, ValueError):
             secho = None
 
-        if "paginator" in context and context["paginator"] is not None:
-            object_count = context["paginator"].count
-        else:
-            object_count = self._count_queryset.count()
-
-        total_records = getattr(self, '_unfiltered_count', None)
-        if total_records is None:
-            total_records = self.get_queryset().count()
-
-        context = {
-            "aaData": self.get_rows(object_list),
-            "iTotalRecords": total_records,
-            "iTotalDisplayRecords": object_count,
+        return {
+            "iTotalRecords": self.get_total_records(),
+            "iTotalDisplayRecords": record_count.count,
+            "sCountType": record_count.count_type,
             "sEcho": secho,
         }
 
+    def should_stream(self):
+        """Whether to stream the rows of the current ajax request (see streaming)"""
+
+        if not self.streaming or self._keyset_keys or not isinstance(self.object_list, QuerySet):
+            return False
+
+        page_size = self.get_paginate_by(self.object_list)
+        return page_size < 0 or page_size >= self.streaming_page_size
+
+    def get_streaming_response(self):
+        """
+        Return a StreamingHttpResponse for the requested page (or every row if
+        iDisplayLength is -1). The counts and live filters are written first
+        followed by the rows a chunk at a time.
+        """
+
+        page_size = self.get_paginate_by(self.object_list)
+        offset = self.get_page_offset(page_size)
+        if page_size < 0:
+            page_qs = self.object_list[offset:]
+        else:
+            page_qs = self.object_list[offset:offset + page_size]
+
+        context = self.get_table_info(self.get_record_count())
         if self.live_filters:
             context["liveFilters"] = self.get_live_filters()
 
-        return context
+        return StreamingHttpResponse(self.stream_context(context, page_qs), content_type='application/json')
+
+    def stream_context(self, context, page_qs):
+        """Yield the JSON for context with an aaData key holding the rows of page_qs"""
+
+        yield utils.json_dumps(context)[:-1] + ', "aaData": ['
+
+        separator = ""
+        for objects in self.iter_page_objects(page_qs):
+            # strip the brackets so each chunk of rows continues the array
+            yield separator + utils.json_dumps(self.get_rows(objects))[1:-1]
+            separator = ", "
+
+        yield "]}"
+
+    def get_record_count(self):
+        """
+        Return a RecordCount for the number of records matching the current
+        filters (iTotalDisplayRecords) according to count_strategy.
+        """
+
+        if getattr(self, "_record_count", None) is not None:
+            return self._record_count
+
+        qs = self._count_queryset
+
+        if self.count_strategy == COUNT_CAPPED:
+            self._record_count = self.get_capped_count(qs)
+            return self._record_count
+
+        estimate = None
+        if self.count_strategy in (COUNT_ESTIMATE, COUNT_HYBRID):
+            estimate = utils.estimate_count(qs)
+
+        if estimate is None or (self.count_strategy == COUNT_HYBRID and estimate < self.count_estimate_threshold):
+            self._record_count = RecordCount(qs.count())
+        else:
+            self._record_count = RecordCount(estimate, COUNT_ESTIMATE)
+
+        return self._record_count
+
+    def get_capped_count(self, qs):
+        """
+        Count the input queryset using a SELECT COUNT(*) FROM (... LIMIT cap + 1)
+        query. The cap is extended past count_cap when a page further into the
+        table is requested so the pagination controls keep moving forwards.
+        """
+
+        page_size = self.get_paginate_by(qs)
+        cap = max(self.count_cap, self.get_page_offset(page_size) + page_size)
+
+        # counting a sliced queryset wraps the LIMIT query in a subquery
+        count = qs[:cap + 1].count()
+        if count > cap:
+            return RecordCount(cap + 1, COUNT_CAPPED)
+        return RecordCount(count)
+
+    def get_paginator(self, queryset, per_page, orphans=0, allow_empty_first_page=True, **kwargs):
+        if getattr(self, "_count_queryset", None) is None:
+            # full page request
+            return super(BaseListableView, self).get_paginator(
+                queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs
+            )
+
+        record_count = self.get_record_count()
+        paginator_class = EstimatedCountPaginator if record_count.count_type != COUNT_EXACT else self.paginator_class
+        paginator = paginator_class(
+            queryset, per_page, orphans=orphans, allow_empty_first_page=allow_empty_first_page, **kwargs
+        )
+        # count is a cached_property so this saves the paginator counting again
+        paginator.count = record_count.count
+        return paginator
+
+    def get_annotations(self):
+        """Return the computed columns (name -> expression) to annotate the queryset with"""
+        return self.annotations
+
+    def annotate_queryset(self, qs, fields=None):
+        """
+        Add the expressions for computed columns to the input queryset so they
+        can be filtered, sorted and counted by the ORM. Declared annotations
+        are selected with annotate() while columns traversing a
+        GenericForeignKey in fields (default all columns) are added with
+        alias() since their page values are fetched separately (see get_rows)
+        and select_annotations selects them where required.
+        """
+
+        annotations = {
+            name: expression for name, expression in self.get_annotations().items()
+            if name not in qs.query.annotations
+        }
+        if annotations:
+            qs = qs.annotate(**annotations)
+
+        if fields is None:
+            fields = self.get_fields(request=self.request)
+
+        expressions = {}
+        for field in fields:
+            if field in qs.query.annotations:
+                continue
+            if utils.generic_lookup(qs.model, field):
+                expressions[field] = self.get_generic_expression(qs.model, field)
+
+        if not expressions:
+            return qs
+
+        return qs.alias(**expressions)
+
+    def select_annotations(self, qs, fields):
+        """Make any of fields added to qs with alias() selectable with values()"""
+
+        aliases = {
+            field: F(field) for field in fields
+            if field in qs.query.annotations and field not in qs.query.annotation_select
+        }
+        return qs.annotate(**aliases) if aliases else qs
+
+    def get_generic_models(self, model, generic_field):
+        """Return the models a GenericForeignKey of model can point at"""
+
+        from django.contrib.contenttypes.models import ContentType
+
+        if generic_field.name in self.generic_models:
+            return list(self.generic_models[generic_field.name])
+
+        ct_field = model._meta.get_field(generic_field.ct_field)
+        limit = ct_field.get_limit_choices_to()
+        if isinstance(limit, Q):
+            content_types = ContentType.objects.filter(limit)
+        elif limit:
+            content_types = ContentType.objects.filter(**limit)
+        else:
+            in_use = model._default_manager.order_by().values(ct_field.attname).distinct()
+            content_types = ContentType.objects.filter(pk__in=in_use)
+
+        # finding the content types in use scans the whole table so the result
+        # is memoised for the view instance and, if the view caches anything
+        # else, cached across requests (and invalidated when the model changes)
+        memo = self.__dict__.setdefault("_generic_content_types", {})
+        memo_key = (model, generic_field.name)
+        if memo_key not in memo:
+            content_types = content_types.order_by("pk").values_list("pk", flat=True)
+            if self.uses_cache():
+                memo[memo_key] = li_cache.get_or_set(
+                    self.get_cache_name("generic_models.%s" % generic_field.name), content_types,
+                    lambda: list(content_types), self.cache_timeout, models=(model, ContentType),
+                )
+            else:
+                memo[memo_key] = list(content_types)
+        pks = memo[memo_key]
+
+        model_classes = (ContentType.objects.get_for_id(pk).model_class() for pk in pks)
+        return [model_class for model_class in model_classes if model_class is not None]
+
+    def get_generic_expression(self, model, field):
+        """
+        Return an expression for a column traversing a GenericForeignKey, i.e.
+        CASE WHEN content_type_id = <ct> THEN (SELECT <field> FROM <table>
+        WHERE id = object_id) ... END for each model the relation can point at.
+        """
+
+        from django.contrib.contenttypes.models import ContentType
+
+        generic_field, lookup = utils.generic_lookup(model, field)
+        ct_field = model._meta.get_field(generic_field.ct_field)
+        fk_field = model._meta.get_field(generic_field.fk_field)
+
+        whens = []
+        output_field = None
+        for related_model in self.get_generic_models(model, generic_field):
+            path = utils.field_path(related_model, lookup)
+            if len(path) != len(lookup.split("__")):
+                continue
+
+            content_type = ContentType.objects.get_for_model(
+                related_model, for_concrete_model=generic_field.for_concrete_model,
+            )
+
+            # e.g. a text object_id pointing at integer primary keys
+            pk_field = getattr(related_model._meta.pk, "target_field", related_model._meta.pk)
+            object_id = OuterRef(fk_field.attname)
+            if isinstance(fk_field, IntegerField) != isinstance(pk_field, IntegerField) or (
+                not isinstance(pk_field, IntegerField) and fk_field.get_internal_type() != pk_field.get_internal_type()
+            ):
+                object_id = Cast(object_id, output_field=pk_field)
+
+            values = related_model._default_manager.filter(pk=object_id).order_by().values(lookup)[:1]
+            whens.append(When(**{ct_field.attname: content_type.pk, "then": Subquery(values)}))
+            output_field = output_field or path[-1]
+
+        if not whens:
+            return Value(None, output_field=CharField())
+
+        return Case(*whens, output_field=output_field.__class__())
+
+    def get_generic_values(self, plan, objects):
+        """
+        Return a dict of pk -> value for a column traversing a
+        GenericForeignKey, fetching the related objects for the page with one
+        query per content type.
+        """
+
+        from django.contrib.contenttypes.models import ContentType
+
+        if not objects:
+            return {}
+
+        model = type(objects[0])
+        generic_field, lookup = utils.generic_lookup(model, plan.field)
+        ct_attname = model._meta.get_field(generic_field.ct_field).attname
+
+        by_content_type = {}
+        for obj in objects:
+            content_type_id = getattr(obj, ct_attname)
+            object_id = getattr(obj, generic_field.fk_field)
+            if content_type_id is not None and object_id is not None:
+                by_content_type.setdefault(content_type_id, []).append((obj.pk, object_id))
+
+        values = {}
+        for content_type_id, rows in by_content_type.items():
+            related_model = ContentType.objects.get_for_id(content_type_id).model_class()
+            if related_model is None:
+                continue
+
+            to_python = related_model._meta.pk.to_python
+            object_ids = {to_python(object_id) for __, object_id in rows}
+            related = dict(related_model._default_manager.filter(pk__in=object_ids).values_list("pk", lookup))
+            for pk, object_id in rows:
+                object_id = to_python(object_id)
+                if object_id in related:
+                    # rows whose object doesn't exist are left out and rendered empty
+                    values[pk] = related[object_id]
+
+        return values
+
+    def related_queryset(self, qs):
+        """Apply select_related, prefetch_related and (when defer is enabled) only() to the input queryset"""
+
+        select_related = list(self.select_related)
+        only = None
+        if self.defer:
+            query_fields = self.get_query_fields(qs)
+            select_related = utils.unique(select_related + query_fields.select_related)
+            only = query_fields.only
+
+        if select_related:
+            qs = qs.select_related(*select_related)
+
+        prefetch_related = self.get_prefetch_related(qs.model)
+        if prefetch_related:
+            qs = qs.prefetch_related(*prefetch_related)
+
+        if only is not None:
+            qs = qs.only(*only)
+
+        return qs
+
+    def get_prefetch_related(self, model):
+        """
+        Return prefetch_related plus a Prefetch for every SELECT_MULTI_FROM_MULTI
+        column (which only loads the displayed field) not already prefetched.
+        """
+
+        prefetch_related = list(self.prefetch_related)
+        prefetched = [getattr(lookup, "prefetch_to", lookup) for lookup in prefetch_related]
+
+        for plan in self.get_column_plan(model, self.get_fields(request=self.request)):
+            if plan.kind != RENDER_RELATED or not plan.multi:
+                continue
+
+            lookup = "__".join(plan.path[:-1])
+            if any(p == lookup or p.startswith(lookup + "__") for p in prefetched):
+                continue
+
+            model_fields = utils.field_path(model, lookup)
+            accessors = [f.get_accessor_name() if f.auto_created and not f.concrete else f.name for f in model_fields]
+            if accessors != list(plan.path[:-1]) or not (model_fields[-1].many_to_many or model_fields[-1].one_to_many):
+                # not a to-many relation that can be traversed by attribute name
+                continue
+
+            relation = model_fields[-1]
+            related_model = relation.related_model
+            try:
+                display_field = related_model._meta.get_field(plan.path[-1])
+            except FieldDoesNotExist:
+                display_field = None
+
+            queryset = None
+            if display_field is not None and display_field.concrete and not display_field.is_relation:
+                only = [display_field.name]
+                if getattr(relation, "object_id_field_name", None):
+                    # GenericRelation
+                    only += [relation.object_id_field_name, relation.content_type_field_name]
+                elif relation.one_to_many:
+                    # reverse foreign key
+                    only.append(relation.field.name)
+                queryset = related_model._default_manager.only(*only)
+
+            prefetch_related.append(Prefetch(lookup, queryset=queryset))
+            prefetched.append(lookup)
+
+        return prefetch_related
+
+    def get_query_fields(self, qs):
+        """
+        Infer the select_related paths and only() fields needed to render the
+        columns of the table from qs. only is None when the fields can't be
+        determined for every column (or qs already defers fields).
+        """
+
+        model = qs.model
+        selected = set(qs.query.extra_select) | set(qs.query.annotation_select)
+        # only() on an already restricted queryset would replace its fields
+        restrict = qs.query.deferred_loading == (frozenset(), True)
+
+        def lookups(value):
+            if isinstance(value, basestring):
+                value = [value]
+            if not isinstance(value, (list, tuple)):
+                return []
+            return [v.lstrip("-") for v in value if isinstance(v, basestring)]
+
+        select_related = []
+        only = []
+        for plan in self.get_column_plan(model, self.get_fields(request=self.request)):
+            field = plan.field
+            if plan.kind == RENDER_CONSTANT or plan.multi or field in selected:
+                # no model fields required (multi columns are prefetched)
+                continue
+
+            if plan.kind == RENDER_GENERIC:
+                generic_field, __ = utils.generic_lookup(model, field)
+                only.extend([generic_field.ct_field, generic_field.fk_field])
+                continue
+
+            if field in self.defer_fields:
+                paths = self.defer_fields[field]
+                if paths is None:
+                    restrict = False
+                    continue
+                paths = lookups(paths)
+            elif plan.kind in (RENDER_BATCH, RENDER_FORMATTER, RENDER_DISPLAY):
+                paths = lookups(self.order_fields.get(field)) + lookups(self.search_fields.get(field))
+            else:
+                paths = [field]
+
+            if not paths:
+                restrict = False
+
+            for path in paths:
+                model_fields = utils.field_path(model, path)
+                if not model_fields or any(f.many_to_many or f.one_to_many for f in model_fields):
+                    restrict = False
+                    continue
+
+                related = [f.name for f in model_fields if f.is_relation]
+                if related:
+                    select_related.append("__".join(related))
+
+                if model_fields[-1].is_relation or (plan.kind not in (RENDER_BATCH, RENDER_FORMATTER, RENDER_DISPLAY) and
+                                                    field not in self.defer_fields and
+                                                    len(model_fields) != len(path.split("__"))):
+                    # the whole related object (or an unknown attribute) is needed
+                    restrict = False
+                    continue
+
+                only.append("__".join(f.name for f in model_fields))
+
+        for lookup in self.get_prefetch_related(model):
+            # forward relations need their foreign key to be prefetched
+            lookup = getattr(lookup, "prefetch_through", lookup)
+            model_fields = utils.field_path(model, lookup.split("__")[0])
+            if model_fields and model_fields[0].concrete:
+                only.append(model_fields[0].name)
+
+        return QueryFields(utils.unique(select_related), utils.unique(only) if restrict else None)
+
+    def get_column_models(self, model, field):
+        """
+        Return the models the values of a column depend on besides those of
+        the queryset: the models along its lookup path and the models used by
+        the subqueries of an annotation or generic column.
+        """
+
+        models = li_cache.lookup_models(model, field)
+
+        annotations = self.get_annotations()
+        if field in annotations:
+            models |= li_cache.expression_models(annotations[field])
+        elif utils.generic_lookup(model, field):
+            models |= li_cache.expression_models(self.get_generic_expression(model, field))
+
+        return models
+
+    def get_cache_name(self, name):
+        """Return a name for cached values unique to this view class"""
+        return "%s.%s.%s" % (self.__class__.__module__, self.__class__.__qualname__, name)
+
+    def get_total_records(self):
+        """
+        Return the number of records before filtering (iTotalRecords), counting
+        the queryset saved by filter_queryset (or get_queryset()) on first use.
+        """
+
+        if getattr(self, "_unfiltered_count", None) is None:
+            qs = getattr(self, "_unfiltered_queryset", None)
+            self._unfiltered_count = self.get_unfiltered_count(qs if qs is not None else self.get_queryset())
+        return self._unfiltered_count
+
+    def get_unfiltered_count(self, qs):
+        """Return the total number of records before filtering (iTotalRecords)"""
+
+        if not self.cache_total_count:
+            return qs.count()
+
+        return li_cache.get_or_set(
+            self.get_cache_name("total_count"), qs, qs.count, self.cache_timeout, extra_scope=self.get_cache_scope(),
+        )
+
+    def get_cache_scope(self):
+        """
+        Return a (hashable) value that further scopes the values this view
+        caches across requests. Cache keys already include the SQL of the
+        queryset in use, so this is only required when cached values depend on
+        something else, e.g. return self.request.user.pk if get_<field>_choices
+        varies per user.
+        """
+        return None
 
     def get_live_filters(self):
-        live_filters = []
+        cached = self.get_cached_live_filters()
+        return self.format_live_filters(cached, self.get_live_filters_values(cached.missing))
 
+    def get_cached_live_filters(self):
+        """
+        Return the CachedLiveFilters for the live filter columns, i.e. the
+        values found in the cache (if cache_live_filters is enabled) and the
+        columns which still need to be queried.
+        """
+
+        fields = self.get_fields(request=self.request)
+
+        live_fields = []
+        for field in fields:
+            filter_allowed = self.search_fields.get(field, True)
+            widget_type = self.get_widget(field)
+            if field not in self.static_live_filters and filter_allowed and widget_type in [SELECT, SELECT_MULTI, SELECT_MULTI_FROM_MULTI]:
+                live_fields.append(field)
+
+        cache_keys = {}
+        distinct_values = {}
+        if self.cache_live_filters:
+            cache_scope = self.get_cache_scope()
+            for field in live_fields:
+                qs = self._live_filters_qs[field]
+                cache_keys[field] = li_cache.queryset_key(
+                    self.get_cache_name("live_filters.%s" % field),
+                    qs,
+                    extra_scope=cache_scope,
+                    models=self.get_column_models(qs.model, field),
+                )
+            cached = li_cache.get_cache().get_many([key for key in cache_keys.values() if key])
+            distinct_values = {field: cached[key] for field, key in cache_keys.items() if key in cached}
+
+        missing = [field for field in live_fields if field not in distinct_values]
+        return CachedLiveFilters(values=distinct_values, cache_keys=cache_keys, missing=missing)
+
+    def get_live_filters_values(self, fields):
+        """Return a dict of field -> distinct values for the input live filter columns"""
+
+        if self.live_filters_union:
+            return self.get_live_filter_values_union(fields)
+        return {field: self.get_live_filter_values(field) for field in fields}
+
+    def format_live_filters(self, cached, missing_values):
+        """
+        Cache the values queried for the missing live filter columns and
+        return the live filters for every column of the table.
+        """
+
+        distinct_values = {**cached.values, **missing_values}
+        if self.cache_live_filters:
+            li_cache.get_cache().set_many(
+                {cached.cache_keys[field]: values for field, values in missing_values.items() if cached.cache_keys[field]},
+                self.cache_timeout,
+            )
+
+        live_filters = []
         for field in self.get_fields(request=self.request):
 
             if field in self.static_live_filters:
                 live_filters.append(self.static_live_filters[field])
-                continue
+            elif field in distinct_values:
+                # values_to_dt calls str on the values so we do the same here
+                live_filters.append([escape(str(x)) if x is not None else NONEORNULL for x in distinct_values[field]])
+            else:
+                live_filters.append(None)
 
-            filter_allowed = self.search_fields.get(field, True)
-            widget_type = self.widgets.get(field, TEXT)
+        return live_filters
 
-            if not filter_allowed or widget_type not in [SELECT, SELECT_MULTI, SELECT_MULTI_FROM_MULTI]:
-                live_filters.append(None)
+    def get_live_filter_values(self, field):
+        """Return the distinct values remaining for a live filter column"""
+        qs = self.select_annotations(self._live_filters_qs[field], [field])
+        return list(qs.order_by().values_list(field, flat=True).distinct())
+
+    def get_live_filter_values_union(self, fields):
+        """
+        Return a dict of field -> distinct values for the input live filter
+        columns using a single UNION ALL of DISTINCT subqueries. Each subquery
+        is tagged with its column index and selects its values into a column of
+        its own so every column keeps its database type. Columns which aren't
+        concrete model fields or annotations (e.g. extra selects) are queried
+        separately.
+        """
+
+        output_fields = {}
+        for field in fields:
+            annotations = self._live_filters_qs[field].query.annotations
+            if field in annotations:
+                try:
+                    output_fields[field] = annotations[field].output_field
+                except FieldError:
+                    # output type can't be resolved, e.g. mixed types
+                    pass
                 continue
 
-            distinct_values = self._live_filters_qs[field].order_by().values_list(field, flat=True).distinct()
+            path = utils.field_path(self._live_filters_qs[field].model, field)
+            if len(path) == len(field.split("__")) and not path[-1].is_relation:
+                output_fields[field] = path[-1]
+
+        union_fields = list(output_fields)
+        distinct_values = {field: [] for field in union_fields}
+        distinct_values.update({
+            field: self.get_live_filter_values(field) for field in fields if field not in output_fields
+        })
+
+        if len(union_fields) < 2:
+            distinct_values.update({field: self.get_live_filter_values(field) for field in union_fields})
+            return distinct_values
+
+        subqueries = []
+        for idx, field in enumerate(union_fields):
+            columns = {"listable_tag": Value(idx)}
+            for col_idx, col_field in enumerate(union_fields):
+                if col_idx == idx:
+                    columns["listable_value_%d" % col_idx] = F(col_field)
+                else:
+                    columns["listable_value_%d" % col_idx] = Value(None, output_field=output_fields[col_field])
+
+            qs = self._live_filters_qs[field].order_by().annotate(**columns).values_list(*columns).distinct()
+            subqueries.append(qs)
 
-            # values_to_dt calls str on the values so we do the same here
-            live_filters.append([escape(str(x)) if x is not None else NONEORNULL for x in distinct_values])
+        for row in subqueries[0].union(*subqueries[1:], all=True):
+            tag = row[0]
+            distinct_values[union_fields[tag]].append(row[tag + 1])
 
-        return live_filters
+        return distinct_values
+
+    def get_export_response(self, export_format):
+        """Return a response streaming every row of the filtered & ordered table in export_format"""
+
+        filename = "%s.%s" % (self.get_export_filename(), export_format)
+        headers = [force_str(self.get_header_for_field(f)) for f in self.get_fields(request=self.request)]
+        rows = self.iter_export_rows()
 
+        if export_format == EXPORT_XLSX:
+            return FileResponse(
+                self.export_xlsx(headers, rows), as_attachment=True, filename=filename,
+                content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+
+        if export_format == EXPORT_CSV:
+            content, content_type = self.export_csv(headers, rows), "text/csv"
+        else:
+            content, content_type = self.export_ndjson(headers, rows), "application/x-ndjson"
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="%s"' % filename
+        return response
+
+    def get_export_filename(self):
+        """File name (without extension) for exports"""
+        return force_str(self.object_list.model._meta.verbose_name_plural).replace(" ", "_")
+
+    def iter_export_rows(self):
+        """Yield the unescaped cell values of every row of the table"""
+        for objects in self.iter_page_objects(self.object_list):
+            yield from self.get_rows(objects, escaped=False)
+
+    def export_csv(self, headers, rows):
+        """Yield the lines of a CSV file for rows"""
+
+        writer = csv.writer(utils.EchoBuffer())
+        yield writer.writerow(headers)
+        for row in rows:
+            yield writer.writerow(["" if value is None else force_str(value) for value in row])
+
+    def export_ndjson(self, headers, rows):
+        """Yield a JSON object (keyed by column header) per row"""
+
+        encoder = DjangoJSONEncoder()
+        for row in rows:
+            yield encoder.encode(dict(zip(headers, row))) + "\n"
+
+    def export_xlsx(self, headers, rows):
+        """
+        Write rows to a write only openpyxl workbook (which keeps rows on disk
+        rather than in memory) and return the saved file.
+        """
+
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            raise ImproperlyConfigured("XLSX exports require openpyxl to be installed")
+
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(headers)
+        for row in rows:
+            sheet.append([utils.excel_value(value) for value in row])
+
+        output = tempfile.TemporaryFile()
+        workbook.save(output)
+        output.seek(0)
+        return output
 
     def get_table_id(self):
 
@@ -335,6 +1342,15 @@ class BaseListableView(ListView):
     def get_fields(self, request=None):
         return self.fields
 
+    def get_widget(self, field):
+        """Return the filter widget type for field (None if the column can't be filtered)"""
+
+        if field in self.widgets:
+            return self.widgets[field]
+        if field in self.search_fields and not self.search_fields[field]:
+            return None
+        return TEXT
+
     def get_header_for_field(self, field):
         try:
             return self.headers[field]
@@ -343,10 +1359,26 @@ class BaseListableView(ListView):
 
     def set_page(self):
         """ Set page requested by DataTables """
-        offset = int(self.search_filters.get("iDisplayStart", 0))
         page_size = self.get_paginate_by(self.object_list)
         page_kwarg = getattr(self, "page_kwarg", "page")
-        self.kwargs[page_kwarg] = offset / page_size + 1
+        self.kwargs[page_kwarg] = self.get_page_offset(page_size) // page_size + 1
+
+    def get_page_offset(self, page_size):
+        """
+        Return the offset of the requested page, i.e. iDisplayStart rounded down
+        to the start of a page when the table is paginated.
+        """
+        offset = int(self.search_filters.get("iDisplayStart", 0))
+        if page_size <= 0:
+            return offset
+        return offset // page_size * page_size
+
+    def check_page_exists(self, object_list, offset, page_size):
+        """Raise Http404 (like Django's paginator) if the page at offset is past the end of the table"""
+        if offset and not object_list:
+            raise Http404(_("Invalid page (%(page_number)s): %(message)s") % {
+                "page_number": offset // page_size + 1, "message": _("That page contains no results"),
+            })
 
     def get_paginate_by(self, queryset):
         """ Get page size requested by DataTables if available else default value"""
@@ -364,15 +1396,40 @@ class BaseListableView(ListView):
         except AttributeError:
             pass
 
-        if self.get_extra() and 'select' in self.get_extra() and field in self.get_extra()['select']:
+        if isinstance(queryset, QuerySet):
+            queryset = self.select_annotations(self.annotate_queryset(queryset, [field]), [field])
+
+        is_extra = bool(self.get_extra() and 'select' in self.get_extra() and field in self.get_extra()['select'])
+        if is_extra:
             queryset = queryset.extra(select=self.get_extra()['select'])
 
         ordering = self.order_fields.get(field, field)
-        if ordering in (False, True, None):
+        if ordering in (False, True, None) or isinstance(ordering, dict):
             ordering = field
+        if isinstance(ordering, basestring):
+            ordering = [ordering]
+        ordering = list(ordering)
+
+        values = queryset.values_list(field, flat=True)
+        if [o.lstrip("-") for o in ordering] == [field]:
+            values = values.order_by(*ordering).distinct()
+        elif len(ordering) == 1 and not is_extra:
+            # Order each distinct value by the first row it would appear in if the
+            # whole table were ordered, i.e. by the min (or max when descending)
+            # of the ordering field, grouping in the database.
+            desc = ordering[0].startswith("-")
+            aggregate = Max if desc else Min
+            values = queryset.values(field).annotate(
+                listable_order=aggregate(ordering[0].lstrip("-"))
+            ).order_by("-listable_order" if desc else "listable_order", field).values_list(field, flat=True)
+        else:
+            # DISTINCT over the field & ordering columns, duplicate field values
+            # are removed below keeping the first occurrence
+            values = values.order_by(*(ordering + [field])).distinct()
+
         filters = [
-            f if f != (None, None) else (NONEORNULL, 'None')
-            for f in queryset.values_list(field, field).order_by(ordering)
+            (v, v) if v is not None else (NONEORNULL, 'None')
+            for v in utils.unique(values)
         ]
 
         if field in self.static_live_filters:
@@ -398,13 +1455,67 @@ class BaseListableView(ListView):
 
         return filters
 
+    def get_ajax_options_context_data(self):
+        """Context data for an ajax request for a page of options for a column in ajax_options"""
+
+        fields = self.get_fields(request=self.request)
+        try:
+            field = fields[int(self.request.GET["iOptionsColumn"])]
+        except (IndexError, ValueError):
+            raise Http404(_("Invalid options column"))
+
+        if field not in self.ajax_options:
+            raise Http404(_("Options for %(field)s are not loaded by ajax") % {"field": field})
+
+        try:
+            page = max(int(self.request.GET.get("iOptionsPage", 1)), 1)
+        except ValueError:
+            page = 1
+
+        options, more = self.get_ajax_options(field, search=self.request.GET.get("sOptionsSearch", ""), page=page)
+
+        return {
+            "sEcho": self.request.GET.get("sEcho"),
+            "aaOptions": utils.values_to_dt(options),
+            "bMore": more,
+        }
+
+    def get_ajax_options(self, field, search="", page=1):
+        """
+        Return a page of (value, label) options for field containing search and
+        whether there are more pages. Options are de-duplicated, searched and
+        sliced in the database and ordered by the field itself. Fields with a
+        get_<field>_choices method and extra select fields are searched in
+        Python instead.
+        """
+
+        queryset = self.get_queryset()
+        size = self.ajax_options_page_size
+        start = (page - 1) * size
+
+        extra = self.get_extra()
+        is_extra = bool(extra and 'select' in extra and field in extra['select'])
+        if is_extra or hasattr(self, f'get_{field}_choices'):
+            search = search.lower()
+            options = [o for o in self.get_filters(field, queryset=queryset) if search in str(o[1]).lower()]
+            return options[start:start + size], len(options) > start + size
+
+        queryset = self.select_annotations(self.annotate_queryset(queryset, [field]), [field])
+        values = queryset.values_list(field, flat=True)
+        if search:
+            values = values.filter(**{"%s__icontains" % field: search})
+        values = list(values.order_by(field).distinct()[start:start + size + 1])
+
+        options = [(v, v) if v is not None else (NONEORNULL, 'None') for v in values[:size]]
+        return options, len(values) > size
+
     def filter_queryset(self, qs):
         """ filter the input queryset according to column definitions.
 
         This method is awful :(
         """
 
-        self._unfiltered_count = qs.order_by()
+        self._unfiltered_queryset = qs.order_by()
 
         cur_tz = timezone.get_current_timezone()
 
@@ -416,7 +1527,7 @@ class BaseListableView(ListView):
 
             search_term = self.search_filters.get("sSearch_%d" % col_num, None)
             filtering = self.search_fields.get(field, True)
-            widget = self.widgets[field]
+            widget = self.get_widget(field)
 
             # would like to use __regex here, but mssql doesn't come standard with __regex functionaliy
             # instead of installing regex_clr, some logic is used
@@ -478,13 +1589,19 @@ class BaseListableView(ListView):
                             qs = qs.extra(where=["{0} LIKE %s".format(self.extra['select'][field])], params=["%{0}%".format(search_term)])
 
                         elif widget in [SELECT, SELECT_MULTI]:
+                            placeholders = ", ".join(["%s"] * len(search_term))
+                            qs = qs.extra(
+                                where=["{0} IN ({1})".format(self.extra['select'][field], placeholders)],
+                                params=list(search_term),
+                            )
 
-                            search_term_string = "("
-                            for st in search_term:
-                                search_term_string = search_term_string + "'" + st + "',"
-                            search_term_string = search_term_string[:-1] + ")"
-
-                            qs = qs.extra(where=["{0} IN {1}".format(self.extra['select'][field], search_term_string)])
+                    elif (
+                        widget in [SELECT_MULTI, SELECT_MULTI_FROM_MULTI] and
+                        len(search_term) >= self.large_selection_threshold
+                    ):
+                        qs_filter = self.get_selection_filter(qs, filtering, search_term)
+                        if qs_filter is not None:
+                            qs_filters[field] = qs_filter
 
                     else:
 
@@ -506,7 +1623,7 @@ class BaseListableView(ListView):
                         elif widget == TEXT and self.loose_text_search:
                             qs_filters[field] = QuerysetFilters(
                                 filters=[Q(**{filtering: term}) for term in smart_split(search_term)],
-                                distinct=False,
+                                distinct=self._filtering_needs_distinct(qs, filtering),
                             )
                         else:
                             qs_filters[field] = QuerysetFilters(
@@ -523,7 +1640,10 @@ class BaseListableView(ListView):
                         for i in range(len(filtering)):
                             filterings = filterings + ('{0}__in'.format(filtering[i]),)
                         queries = reduce(lambda q, f: q | Q(**{f: search_term}), filterings, Q())
-                        qs_filters[field] = QuerysetFilters(filters=[queries], distinct=False)
+                        qs_filters[field] = QuerysetFilters(
+                            filters=[queries],
+                            distinct=any(self._filtering_needs_distinct(qs, f) for f in filterings),
+                        )
 
                     elif widget == TEXT:
                         queries = Q()
@@ -531,11 +1651,20 @@ class BaseListableView(ListView):
                             if "__icontains" in f:
                                 search_term = search_term.lower()
                             queries |= Q(**{f: search_term})
-                        qs_filters[field] = QuerysetFilters(filters=[queries], distinct=False)
+                        qs_filters[field] = QuerysetFilters(
+                            filters=[queries],
+                            distinct=any(self._filtering_needs_distinct(qs, f) for f in filtering),
+                        )
 
                     elif widget in [DATE, DATE_RANGE, SELECT_MULTI_FROM_MULTI]:
                         raise ValueError('%s widget not configurable for multiple filters.' % widget)
 
+        if self.exists_filters:
+            qs_filters = {
+                field: self.get_exists_filters(qs, qs_filter) if qs_filter.distinct else qs_filter
+                for field, qs_filter in qs_filters.items()
+            }
+
         # for column specific filters (to determine live filter options), we point
         # back to the original queryset to start with and then apply filters below
         self._live_filters_qs = {
@@ -570,6 +1699,86 @@ class BaseListableView(ListView):
 
         return qs
 
+    def get_selection_filter(self, qs, filtering, selected):
+        """
+        Return the QuerysetFilters for a large SELECT_MULTI selection of
+        filtering or None if every value of the column is selected. The
+        distinct values of the column are cached like the filter options when
+        cache_filter_options is set.
+        """
+
+        lookup_qs = self.select_annotations(qs, [filtering]).order_by().values_list(filtering, flat=True).distinct()
+        if self.cache_filter_options:
+            distinct = li_cache.get_or_set(
+                self.get_cache_name("selection.%s" % filtering), lookup_qs, lambda: list(lookup_qs),
+                self.cache_timeout, extra_scope=self.get_cache_scope(),
+                models=self.get_column_models(qs.model, filtering),
+            )
+        else:
+            distinct = lookup_qs
+
+        values = {}
+        for value in distinct:
+            values[NONEORNULL if value is None else str(value)] = value
+
+        selected = set(selected)
+        if selected.issuperset(values):
+            return None
+
+        chosen = [value for key, value in values.items() if key in selected]
+        excluded = [value for key, value in values.items() if key not in selected]
+        to_many = self._filtering_needs_distinct(qs, filtering)
+
+        # for to-many lookups NOT IN would exclude rows with any unselected
+        # related value rather than keeping rows with any selected one
+        if not to_many and len(excluded) < len(chosen):
+            excluded_values = [value for value in excluded if value is not None]
+            q = ~Q(**{"{0}__in".format(filtering): excluded_values}) if excluded_values else Q()
+            if len(excluded_values) < len(excluded):
+                q &= Q(**{"{0}__isnull".format(filtering): False})
+            return QuerysetFilters(filters=[q], distinct=False)
+
+        chosen_values = [value for value in chosen if value is not None]
+        q = Q(**{"{0}__in".format(filtering): self.get_values_expression(qs, filtering, chosen_values)})
+        if len(chosen_values) < len(chosen):
+            q |= Q(**{"{0}__isnull".format(filtering): True})
+        return QuerysetFilters(filters=[q], distinct=to_many)
+
+    def get_values_expression(self, qs, lookup, values):
+        """
+        Return values for an __in filter on lookup as a subquery over a single
+        array parameter where the database supports one, otherwise the values
+        themselves.
+        """
+
+        connection = connections[qs.db]
+        path = utils.field_path(qs.model, lookup)
+        if not values or len(path) != len(lookup.split("__")):
+            return values
+
+        output_field = path[-1]
+        prepped = [output_field.get_db_prep_value(value, connection) for value in values]
+
+        if connection.vendor == "postgresql":
+            return RawSQL("SELECT unnest(%s)", [prepped], output_field=output_field)
+
+        if connection.vendor == "sqlite" and all(isinstance(v, (str, int, float)) for v in prepped):
+            return RawSQL("SELECT value FROM json_each(%s)", [json.dumps(prepped)], output_field=output_field)
+
+        return values
+
+    def get_exists_filters(self, qs, qs_filter):
+        """
+        Rewrite filters traversing a to-many relation as a correlated
+        EXISTS (SELECT ... WHERE pk = outer pk AND <filters>) subquery which
+        matches each row of qs at most once, so no DISTINCT is required. The
+        subquery is built from qs so the filters can still refer to its
+        annotations.
+        """
+
+        matches = qs.filter(*qs_filter.filters).filter(pk=OuterRef("pk"))
+        return QuerysetFilters(filters=[Exists(matches.order_by().values("pk"))], distinct=False)
+
     def get_extra(self):
         return None
 
@@ -619,56 +1828,488 @@ class BaseListableView(ListView):
 
         return qs.order_by(*orderings)
 
-    def get_rows(self, objects):
-        rows = []
+    def get_keyset_keys(self, qs):
+        """
+        Return a list of (field path, descending) tuples describing the ordering
+        of the input queryset (with a pk tiebreaker), or None if the ordering can
+        not be used for keyset pagination.
+        """
+
+        orderings = list(qs.query.order_by)
+        if not orderings and qs.query.default_ordering:
+            orderings = list(qs.model._meta.ordering)
+
+        keys = []
+        for ordering in orderings:
+            if not isinstance(ordering, basestring) or ordering == "?":
+                return None
+
+            path = ordering.lstrip("-")
+            fields = utils.field_path(qs.model, path)
+            if len(fields) != len(path.split("__")):
+                # annotations, extra selects etc
+                return None
+
+            for field in fields:
+                if getattr(field, "many_to_many", False) or getattr(field, "one_to_many", False):
+                    return None
+
+            # ordering by a relation uses the related models ordering and null
+            # values (including those from a LEFT JOIN through a nullable
+            # relation) can't be compared so neither can be used as a key
+            if fields[-1].is_relation or any(field.null for field in fields):
+                return None
+
+            keys.append((path, ordering.startswith("-")))
+
+        if not keys or keys[-1][0] not in ("pk", qs.model._meta.pk.name):
+            keys.append(("pk", False))
+
+        return keys
+
+    def keyset_queryset(self, qs):
+        """
+        Add the pk tiebreaker and cursor value annotations required for keyset
+        pagination to the (ordered) input queryset.
+        """
+
+        self._keyset_keys = self.get_keyset_keys(qs)
+        if not self._keyset_keys:
+            return qs
+
+        orderings = ["%s%s" % ("-" if desc else "", path) for path, desc in self._keyset_keys]
+        cursor_values = {"_listable_cursor_%d" % idx: F(path) for idx, (path, __) in enumerate(self._keyset_keys)}
+
+        return qs.order_by(*orderings).annotate(**cursor_values)
+
+    def get_cursor(self, obj, direction):
+        """Return an encoded cursor pointing before (PREV) or after (NEXT) obj"""
+
+        values = [getattr(obj, "_listable_cursor_%d" % idx) for idx in range(len(self._keyset_keys))]
+        return utils.encode_cursor({
+            "d": direction,
+            "k": [path for path, __ in self._keyset_keys],
+            "o": [desc for __, desc in self._keyset_keys],
+            "f": self.get_cursor_state(),
+            "v": values,
+        })
+
+    def get_cursor_state(self):
+        """
+        Return a hash of the search & sort parameters of the current request.
+        Cursors are only valid for the filters and ordering they were created
+        with since DataTables resets to the first page when they change.
+        """
+
+        state = []
+        for key, value in self.search_filters.items():
+            if re.match(r"^sSearch(_\d+)?$", key) and value not in ("", None):
+                state.append((key, str(value)))
+
+        sorting_cols = int(self.search_filters.get("iSortingCols", 0) or 0)
+        for idx in range(sorting_cols):
+            for key in ("iSortCol_%d" % idx, "sSortDir_%d" % idx):
+                state.append((key, str(self.search_filters.get(key, ""))))
+
+        return hashlib.sha1(json.dumps(sorted(state)).encode("utf-8")).hexdigest()
+
+    def get_cursor_values(self, qs, values):
+        """
+        Convert the (client supplied) cursor values with the to_python method of
+        each key field. Returns None if any of the values are invalid.
+        """
+
+        converted = []
+        for (path, __), value in zip(self._keyset_keys, values):
+            field = utils.field_path(qs.model, path)[-1]
+            try:
+                value = field.to_python(value)
+            except (ValidationError, ValueError, TypeError):
+                return None
+            if value is None:
+                # key fields are never null
+                return None
+            converted.append(value)
+        return converted
+
+    def get_keyset_page(self, qs):
+        """
+        Return (object_list, has_previous, has_next) for the page identified by
+        the `sCursor` request parameter or None if there is no valid cursor.
+        """
+
+        cursor = self.search_filters.get("sCursor")
+        page_size = self.get_paginate_by(qs)
+        if not cursor or page_size <= 0:
+            return None
+
+        cursor = utils.decode_cursor(cursor)
+        try:
+            direction, values = cursor["d"], cursor["v"]
+            valid = (
+                direction in (NEXT, PREV) and
+                cursor["k"] == [path for path, __ in self._keyset_keys] and
+                cursor["o"] == [desc for __, desc in self._keyset_keys] and
+                cursor["f"] == self.get_cursor_state() and
+                len(values) == len(self._keyset_keys)
+            )
+        except (KeyError, TypeError):
+            valid = False
+
+        if not valid:
+            return None
+
+        values = self.get_cursor_values(qs, values)
+        if values is None:
+            return None
+
+        backwards = direction == PREV
+
+        # (k1 > v1) OR (k1 = v1 AND k2 > v2) OR ... with the comparison flipped
+        # for descending keys and again when paging backwards
+        seek = Q()
+        for idx, (path, desc) in enumerate(self._keyset_keys):
+            lookup = "lt" if desc != backwards else "gt"
+            equal = {key_path: values[i] for i, (key_path, __) in enumerate(self._keyset_keys[:idx])}
+            seek |= Q(**equal) & Q(**{"%s__%s" % (path, lookup): values[idx]})
+
+        qs = qs.filter(seek)
+        if backwards:
+            qs = qs.reverse()
+
+        # fetch one extra row to find out whether there is another page
+        cursor_values = ["_listable_cursor_%d" % idx for idx in range(len(self._keyset_keys))]
+        object_list = self.get_page_objects(qs[:page_size + 1], annotations=cursor_values)
+        has_more = len(object_list) > page_size
+        object_list = object_list[:page_size]
+
+        if backwards:
+            object_list.reverse()
+            return object_list, has_more, True
+
+        return object_list, True, has_more
+
+    def get_window_page(self, qs):
+        """
+        Return (object_list, has_previous, has_next) for the requested page,
+        fetching the filtered record count in the same query using a
+        COUNT(*) OVER () window function. Returns None if a window function
+        can't be used or the page is empty.
+        """
+
+        page_size = self.get_paginate_by(qs)
+        can_use_window = (
+            page_size > 0 and
+            not self.extra and
+            not qs.query.combinator and
+            not qs.query.distinct and
+            connections[qs.db].features.supports_over_clause
+        )
+        if not can_use_window:
+            return None
+
+        offset = self.get_page_offset(page_size)
+
+        qs = qs.annotate(_listable_count=Window(expression=Count("*")))
+        object_list = self.get_page_objects(qs[offset:offset + page_size], annotations=["_listable_count"])
+        if not object_list:
+            # either nothing matches or the page is past the end
+            return None
+
+        count = object_list[0]._listable_count
+        self._record_count = RecordCount(count)
+
+        return object_list, offset > 0, offset + len(object_list) < count
+
+    def get_page_objects(self, page_qs, annotations=()):
+        """
+        Evaluate the (sliced) page queryset and return a list of objects. When
+        deferred_join is enabled only the primary keys (and the requested
+        annotations) are selected by the page query and the full rows are
+        then loaded by pk, preserving the page order.
+        """
+
+        projection = self.get_projection(page_qs)
+        if projection is not None:
+            # rendered from the projected values, see get_rows
+            self._projection_model = page_qs.model
+
+        if self._deferred_queryset is None:
+            if projection is None:
+                return list(page_qs)
+            # annotations are included like they would be on model instances
+            names = utils.unique(projection + list(annotations) + list(page_qs.query.annotation_select))
+            return [ProjectedRow(names, row) for row in page_qs.values_list(*names)]
+
+        rows = list(page_qs.values_list("pk", *annotations))
+        return self.get_deferred_objects(rows, projection, annotations)
+
+    def get_deferred_objects(self, rows, projection, annotations=()):
+        """
+        Load the full rows (or projected values) for a list of (pk, *annotations)
+        rows from the deferred queryset, preserving their order.
+        """
+
+        pks = [row[0] for row in rows]
+        if projection is None:
+            objects = self._deferred_queryset.in_bulk(pks)
+        else:
+            values = self._deferred_queryset.prefetch_related(None).filter(pk__in=pks)
+            names = utils.unique(["pk"] + projection + list(values.query.annotation_select))
+            values = values.values_list(*names)
+            objects = {row[0]: ProjectedRow(names, row) for row in values}
+
+        page = []
+        for row in rows:
+            obj = objects.get(row[0])
+            if obj is None:
+                # deleted between the two queries
+                continue
+            for name, value in zip(annotations, row[1:]):
+                setattr(obj, name, value)
+            page.append(obj)
+
+        return page
+
+    def iter_page_objects(self, page_qs):
+        """
+        Yield the objects of page_qs in lists of streaming_chunk_size fetched
+        with a single iterator(), i.e. a server side cursor where supported.
+        """
+
+        chunk_size = self.streaming_chunk_size
+        projection = self.get_projection(page_qs)
+        if projection is not None:
+            self._projection_model = page_qs.model
+
+        # iterator() only applies prefetch_related from Django 4.1 so before
+        # that the lookups are prefetched for each chunk here
+        prefetch = ()
+        if django.VERSION < (4, 1) and projection is None and self._deferred_queryset is None:
+            prefetch = page_qs._prefetch_related_lookups
+
+        if self._deferred_queryset is not None:
+            rows = page_qs.values_list("pk").iterator(chunk_size=chunk_size)
+        elif projection is None:
+            rows = page_qs.iterator(chunk_size=chunk_size)
+        else:
+            names = utils.unique(projection + list(page_qs.query.annotation_select))
+            rows = (ProjectedRow(names, row) for row in page_qs.values_list(*names).iterator(chunk_size=chunk_size))
+
+        while True:
+            objects = list(islice(rows, chunk_size))
+            if not objects:
+                return
+            if self._deferred_queryset is not None:
+                objects = self.get_deferred_objects(objects, projection)
+            elif prefetch:
+                prefetch_related_objects(objects, *prefetch)
+            yield objects
+
+    def get_projection(self, qs):
+        """
+        Return the list of values_list() names required to render the columns
+        from qs or None if values_projection is disabled or any column
+        requires a model instance.
+        """
+
+        cls = type(self)
+        if not self.values_projection or cls.format_col is not BaseListableView.format_col or \
+                cls._format_col is not BaseListableView._format_col:
+            return None
+
+        selected = set(qs.query.extra_select) | set(qs.query.annotation_select)
+
+        names = []
+        for plan in self.get_column_plan(qs.model, self.get_fields(request=self.request)):
+            if plan.kind == RENDER_CONSTANT:
+                continue
+            if plan.kind == RENDER_GENERIC or not (plan.projectable or plan.field in selected):
+                return None
+            names.append(plan.field)
+
+        return utils.unique(names)
+
+    def get_rows(self, objects, escaped=True):
+        """
+        Return the cells for each of objects, HTML escaped unless escaped is
+        False (e.g. for exports).
+        """
+
         fields = self.get_fields(request=self.request)
-        for obj in objects:
-            rows.append([self.format_col(field, obj) for field in fields])
-        return rows
+
+        cls = type(self)
+        if cls.format_col is not BaseListableView.format_col or cls._format_col is not BaseListableView._format_col:
+            # cell formatting is customised so format every cell individually
+            format_col = self.format_col if escaped else self._format_col
+            return [[format_col(field, obj) for field in fields] for obj in objects]
+
+        objects = list(objects)
+        if not objects:
+            return []
+
+        projected = isinstance(objects[0], ProjectedRow)
+        model = self._projection_model if projected else type(objects[0])
+        renderers = [self.get_column_renderer(plan, projected, objects) for plan in self.get_column_plan(model, fields)]
+        if not escaped:
+            return [[render(obj) for render in renderers] for obj in objects]
+
+        escape_ = conditional_escape
+        return [[escape_(render(obj)) for render in renderers] for obj in objects]
 
     def format_col(self, field, obj):
         """Escape contents unless they're already marked safe or escaped."""
         return conditional_escape(self._format_col(field, obj))
 
     def _format_col(self, field, obj):
+        plan, = self.get_column_plan(type(obj), [field])
+        return self.get_column_renderer(plan, objects=[obj])(obj)
 
-        is_multi = self.widgets[field] == SELECT_MULTI_FROM_MULTI
+    @classmethod
+    def get_column_plan(cls, model, fields):
+        """
+        Return the compiled ColumnPlan's for fields of model. Plans are
+        compiled once and cached on the view class.
+        """
+
+        plans = cls.__dict__.get("_column_plans")
+        if plans is None:
+            plans = {}
+            cls._column_plans = plans
+
+        key = (model, tuple(fields))
+        if key not in plans:
+            plans[key] = tuple(cls.compile_column(model, field) for field in fields)
+        return plans[key]
+
+    @classmethod
+    def compile_column(cls, model, field):
+        """
+        Determine how cells for field are rendered. In order of precedence:
+        a format_<field>_batch method on the view, a formatter (method or
+        value) on the view, a lookup through a GenericForeignKey, a related
+        field using __ notation, a model get_<field>_display method and
+        finally the model attribute itself.
+        """
+
+        is_multi = cls.widgets.get(field) == SELECT_MULTI_FROM_MULTI
+
+        if callable(getattr(cls, 'format_{0}_batch'.format(field), None)):
+            return ColumnPlan(field, RENDER_BATCH)
 
-        # first see if view subclass has a formatter defined
-        formatter = getattr(self, field, None)
+        formatter = getattr(cls, field, None)
         if formatter:
-            return formatter(obj) if callable(formatter) else formatter
+            return ColumnPlan(field, RENDER_FORMATTER if callable(formatter) else RENDER_CONSTANT)
+
+        if utils.generic_lookup(model, field):
+            return ColumnPlan(field, RENDER_GENERIC, path=tuple(field.split("__", 1)))
+
+        path = utils.field_path(model, field)
+        projectable = (
+            len(path) == len(field.split("__")) and
+            not any(f.many_to_many or f.one_to_many for f in path) and
+            not path[-1].is_relation and
+            path[-1].concrete
+        )
 
-        # fk property
         if "__" in field:
-            if is_multi:
-                return self.multi_separator.join(utils.lookup_dunder_prop(obj, field, multi=True))
-            return utils.lookup_dunder_prop(obj, field)
+            return ColumnPlan(
+                field, RENDER_RELATED, path=tuple(field.split("__")), multi=is_multi,
+                projectable=projectable and not is_multi,
+            )
         elif is_multi:
             raise AttributeError("Must specify field to display for many to many field (ie: %s__id)" % field)
 
-        try:
-            return getattr(obj, 'get_{0}_display'.format(field))()
-        except AttributeError:
-            pass
+        display = 'get_{0}_display'.format(field)
+        display_method = inspect.getattr_static(model, display, None)
+        if display_method is None:
+            return ColumnPlan(field, RENDER_ATTR, projectable=projectable)
 
         try:
-            attr = getattr(obj, field)
-        except AttributeError:
-            raise AttributeError("'%s' is not a valid format specifier" % (field))
+            model_field = model._meta.get_field(field)
+        except FieldDoesNotExist:
+            model_field = None
 
-        if callable(attr):
-            return attr()
-        elif isinstance(attr, datetime.datetime):
-            return formats.date_format(attr, "SHORT_DATETIME_FORMAT")
-        elif isinstance(attr, datetime.date):
-            return formats.date_format(attr, "SHORT_DATE_FORMAT")
-        elif isinstance(attr, six.string_types):
-            attr.encode("UTF-8")
-        elif attr is None:
-            return ""
+        is_choices_display = (
+            model_field is not None and model_field.choices and
+            getattr(display_method, "func", None) is getattr(model, "_get_FIELD_display", None)
+        )
+        if is_choices_display:
+            # the standard Django get_FOO_display method so look up the label directly
+            choices = {make_hashable(k): v for k, v in model_field.flatchoices}
+            return ColumnPlan(field, RENDER_CHOICES, choices=MappingProxyType(choices), projectable=projectable)
+
+        return ColumnPlan(field, RENDER_DISPLAY)
+
+    def get_column_renderer(self, plan, projected=False, objects=()):
+        """
+        Return a callable rendering the (unescaped) cell for a column plan
+        from an object (or a ProjectedRow when projected is True). objects
+        is the page being rendered which is passed to batch formatters.
+        """
+
+        field = plan.field
+
+        if plan.kind == RENDER_BATCH:
+            # format_<field>_batch(objects) returns the values for the page keyed by pk
+            values = getattr(self, 'format_{0}_batch'.format(field))(objects)
+            return lambda obj: values.get(obj.pk, "")
+
+        if plan.kind == RENDER_GENERIC:
+            values = self.get_generic_values(plan, objects)
+            return lambda obj: values.get(obj.pk, "")
+
+        if projected and plan.kind == RENDER_RELATED:
+            # values are fetched using the full lookup as the name
+            return attrgetter(field)
+
+        if plan.kind == RENDER_FORMATTER:
+            return getattr(self, field)
+
+        if plan.kind == RENDER_CONSTANT:
+            value = getattr(self, field)
+            return lambda obj: value
+
+        if plan.kind == RENDER_RELATED:
+            if plan.multi:
+                get_manager = attrgetter(".".join(plan.path[:-1]))
+                attr = plan.path[-1]
+                separator = self.multi_separator
+
+                def render(obj):
+                    try:
+                        return separator.join([getattr(o, attr) for o in get_manager(obj).all()])
+                    except AttributeError:
+                        return None
+            else:
+                get_value = attrgetter(".".join(plan.path))
+
+                def render(obj):
+                    try:
+                        return get_value(obj)
+                    except AttributeError:
+                        return None
+            return render
+
+        if plan.kind == RENDER_CHOICES:
+            choices = plan.choices
+
+            def render(obj):
+                value = getattr(obj, field)
+                return force_str(choices.get(make_hashable(value), value), strings_only=True)
+            return render
+
+        if plan.kind == RENDER_DISPLAY:
+            return methodcaller('get_{0}_display'.format(field))
 
-        return "%s" % attr
+        def render(obj):
+            try:
+                attr = getattr(obj, field)
+            except AttributeError:
+                raise AttributeError("'%s' is not a valid format specifier" % (field))
+            return format_attr(attr)
+
+        return render
 
     def set_query_params(self):
         """
@@ -726,3 +2367,129 @@ class BaseListableView(ListView):
                     cookie_dt_params = None
 
         return cookie_dt_params
+
+
+class AsyncBaseListableView(BaseListableView):
+    """
+    Async version of BaseListableView for use under ASGI. The DataTables ajax
+    requests await the filtered record count, the unfiltered count, the page
+    rows and the live filter values concurrently (asyncio.gather) using the
+    async queryset API. Everything else (full page loads, ajax options,
+    exports, streaming, keyset and window count pages) runs the sync view in
+    a thread, and all the usual hooks (get_queryset, get_extra, formatters,
+    get_<field>_choices etc) are still called synchronously. Streamed pages
+    and exports are still produced a chunk at a time (see async_streaming).
+    Requires Django 4.1 or later.
+    """
+
+    async def get(self, request, *args, **kwargs):
+
+        if django.VERSION < (4, 1):
+            raise ImproperlyConfigured("AsyncBaseListableView requires Django 4.1 or later (async queryset API)")
+
+        is_ajax = request.headers.get('x-requested-with') == 'XMLHttpRequest'
+        if not is_ajax or "sExport" in request.GET or "iOptionsColumn" in request.GET:
+            return self.async_streaming(await sync_to_async(super().get)(request, *args, **kwargs))
+
+        def prepare():
+            self.init_table()
+            self.prepare_table()
+
+        await sync_to_async(prepare)()
+
+        if not self.get_allow_empty() and not await self.object_list.aexists():
+            raise Http404(_("Empty list and '%(class_name)s.allow_empty' is False.").format(class_name=self.__class__.__name__))
+
+        if self.should_stream():
+            return self.async_streaming(await sync_to_async(self.get_streaming_response)())
+
+        context = await self.aget_table_context_data()
+        return HttpResponse(utils.json_dumps(context), content_type='application/json')
+
+    def async_streaming(self, response):
+        """
+        Give a streaming response with sync content (streamed pages, exports)
+        async content generated a chunk at a time in a thread. Django would
+        otherwise consume the whole sync iterator into memory before sending
+        it under ASGI.
+        """
+
+        if response.streaming and not response.is_async:
+            response.streaming_content = utils.aiter_sync(response.streaming_content)
+        return response
+
+    async def aget_table_context_data(self):
+        """Async version of get_table_context_data"""
+
+        page_size = self.get_paginate_by(self.object_list)
+        if self._keyset_keys or self.count_strategy == COUNT_WINDOW or page_size <= 0:
+            # the page & count are fetched together (or not paginated at all)
+            return await sync_to_async(self.get_table_context_data)(object_list=self.object_list)
+
+        offset = self.get_page_offset(page_size)
+        page_qs = self.object_list[offset:offset + page_size]
+
+        queries = [
+            self.aget_record_count(),
+            self.aget_unfiltered_count(self._unfiltered_queryset),
+            self.aget_page_objects(page_qs),
+        ]
+        if self.live_filters:
+            queries.append(self.aget_live_filters())
+
+        record_count, self._unfiltered_count, object_list, *live_filters = await asyncio.gather(*queries)
+
+        self.check_page_exists(object_list, offset, page_size)
+
+        context = self.get_table_info(record_count)
+        context["aaData"] = await sync_to_async(self.get_rows)(object_list)
+
+        if live_filters:
+            context["liveFilters"] = live_filters[0]
+
+        return context
+
+    async def aget_record_count(self):
+        """Async version of get_record_count. Only COUNT_EXACT counts use acount."""
+
+        if self.count_strategy != COUNT_EXACT:
+            return await sync_to_async(self.get_record_count)()
+
+        if self._record_count is None:
+            self._record_count = RecordCount(await self._count_queryset.acount())
+        return self._record_count
+
+    async def aget_unfiltered_count(self, qs=None):
+        """Async version of get_unfiltered_count. qs defaults to get_queryset()"""
+
+        if qs is None:
+            qs = await sync_to_async(self.get_queryset)()
+
+        if self.cache_total_count:
+            return await sync_to_async(self.get_unfiltered_count)(qs)
+        return await qs.acount()
+
+    async def aget_page_objects(self, page_qs):
+        """Async version of get_page_objects"""
+
+        if self._deferred_queryset is not None or self.get_projection(page_qs) is not None:
+            return await sync_to_async(self.get_page_objects)(page_qs)
+        return [obj async for obj in page_qs]
+
+    async def aget_live_filters(self):
+        """Async version of get_live_filters querying each missing column concurrently"""
+
+        cached = await sync_to_async(self.get_cached_live_filters)()
+
+        if self.live_filters_union:
+            missing_values = await sync_to_async(self.get_live_filter_values_union)(cached.missing)
+        else:
+            values = await asyncio.gather(*[self.aget_live_filter_values(field) for field in cached.missing])
+            missing_values = dict(zip(cached.missing, values))
+
+        return await sync_to_async(self.format_live_filters)(cached, missing_values)
+
+    async def aget_live_filter_values(self, field):
+        """Async version of get_live_filter_values"""
+        qs = self.select_annotations(self._live_filters_qs[field], [field])
+        return [value async for value in qs.order_by().values_list(field, flat=True).distinct()]
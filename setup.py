@@ -51,6 +51,7 @@ setup(
     ],
     include_package_data=True,
     install_requires=install_requires,
+    extras_require={"xlsx": ["openpyxl"]},
     license="BSD-3-Clause",
     zip_safe=False,
     keywords='django-listable',
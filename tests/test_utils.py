@@ -1,9 +1,20 @@
+import json
+import sys
+from unittest import mock, skipUnless
 from unittest.mock import Mock
 
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.utils.translation import gettext_lazy
 from listable import utils
 import pytest
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from staff.models import Staff
 from staff.views import StaffList
 
 
@@ -31,3 +42,34 @@ class TestUtils(TestCase):
 
     def test_unicode_unquote_4(self):
         assert utils.unquote_unicode("%F0%9F%91%8D%F0%9F%8F%BD%20%F0%9F%91%A9%E2%80%8D%F0%9F%91%A9%E2%80%8D%F0%9F%91%A7%E2%80%8D%F0%9F%91%A6%20%F0%90%8D%88%20%E2%AD%90%EF%B8%8F%20%C3%A9%20%E6%BC%A2%E5%AD%97%20%D9%85%D8%B1%D8%AD%D8%A8%D8%A7%20a%CC%81%20%E2%88%91%20%E2%80%94", encoding="utf-8") == "👍🏽 👩‍👩‍👧‍👦 𐍈 ⭐️ é 漢字 مرحبا á ∑ —"
+
+    def test_estimate_count_unsupported(self):
+        assert utils.estimate_count(Staff.objects.all()) is None
+
+    def _assert_json_encoders(self, names):
+        value = {"aaData": [["1", "Caf\u00e9 &amp; <b>"]], "sEcho": None, "label": gettext_lazy("Position")}
+        expected = {"aaData": [["1", "Caf\u00e9 &amp; <b>"]], "sEcho": None, "label": "Position"}
+
+        for name in names:
+            if name == "json.dumps":
+                value = dict(value, label="Position")
+            with mock.patch("listable.settings.LISTABLE_JSON_ENCODER", name):
+                dumped = utils.json_dumps(value)
+            self.assertIsInstance(dumped, str)
+            self.assertEqual(json.loads(dumped), expected)
+
+    def test_json_encoders(self):
+        self._assert_json_encoders(("auto", "json", "json.dumps"))
+
+    @skipUnless(orjson, "orjson is not installed")
+    def test_orjson_encoder(self):
+        self._assert_json_encoders(("orjson",))
+
+    def test_json_encoder_fallback(self):
+        with mock.patch.dict(utils._json_encoders, clear=True), mock.patch.dict(sys.modules, {"orjson": None}):
+            self.assertIs(utils.get_json_encoder("auto"), utils._stdlib_dumps)
+            with self.assertRaises(ImproperlyConfigured):
+                utils.get_json_encoder("orjson")
+
+        with self.assertRaises(ImproperlyConfigured):
+            utils.get_json_encoder("listable.nonexistent.dumps")
@@ -1,20 +1,41 @@
 import codecs
 import datetime
+from html import unescape
 import json
 import sys
 
-from unittest import mock
+from unittest import mock, skipUnless
 
-from django.db.models import Q, QuerySet
-from django.test import Client, TestCase
+from asgiref.sync import sync_to_async
+
+import django
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.db import connection
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import escape
+from listable import cache as li_cache
 from listable import settings as lisettings
-from listable.utils import localize_dt
+from listable import views as liviews
+from listable import utils
+from listable.utils import localize_dt, unique
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-from staff.models import INACTIVE, Staff
-from staff.views import StaffListStaticLiveFilters
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+from staff.models import INACTIVE, ContractType, GenericModelA, GenericModelB, Staff
+from staff.views import StaffList, StaffListNoGeneric, StaffListStaticLiveFilters
 
 
 sys.path.append("listable-demo")
@@ -34,6 +55,14 @@ class TestViews(TestCase):
         response = client.get(reverse("staff-list"))
         self.assertEqual(response.status_code, 200)
 
+    def test_demo_pages_use_own_url(self):
+        """Views sharing the staff list template drive their own ajax endpoint"""
+
+        for name in ("staff-list", "staff-list-keyset", "staff-list-batch", "staff-list-generic"):
+            response = self.client.get(reverse(name))
+            opts = json.loads(response.content.decode("utf-8").split("var Listable = ")[1].split(";</script>")[0])
+            self.assertEqual(opts["url"], reverse(name))
+
     def test_data_load(self):
         # full query = "sEcho=1&iColumns=8&sColumns=&iDisplayStart=10&iDisplayLength=10&mDataProp_0=0&mDataProp_1=1&mDataProp_2=2&mDataProp_3=3&mDataProp_4=4&mDataProp_5=5&mDataProp_6=6&mDataProp_7=7&sSearch=&bRegex=false&sSearch_0=&bRegex_0=false&bSearchable_0=true&sSearch_1=&bRegex_1=false&bSearchable_1=true&sSearch_2=&bRegex_2=false&bSearchable_2=true&sSearch_3=&bRegex_3=false&bSearchable_3=true&sSearch_4=&bRegex_4=false&bSearchable_4=true&sSearch_5=&bRegex_5=false&bSearchable_5=true&sSearch_6=&bRegex_6=false&bSearchable_6=true&sSearch_7=&bRegex_7=false&bSearchable_7=true&iSortingCols=0&bSortable_0=true&bSortable_1=true&bSortable_2=true&bSortable_3=true&bSortable_4=true&bSortable_5=true&bSortable_6=true&bSortable_7=true&_=1414439607636"
         client = Client()
@@ -308,7 +337,7 @@ class TestViews(TestCase):
         self.assertListEqual(names, payload_names)
 
     def test_cached_unfiltered_count(self):
-        """iTotalRecords should use _unfiltered_count cached in filter_queryset
+        """iTotalRecords should count the _unfiltered_queryset saved in filter_queryset
         rather than calling get_queryset().count() again."""
 
         client = Client()
@@ -351,33 +380,48 @@ class TestViews(TestCase):
         inactive_count = Staff.objects.filter(active=INACTIVE).count()
         self.assertEqual(payload['iTotalDisplayRecords'], inactive_count)
 
-    def test_cached_unfiltered_count_with_extra_count_fallback(self):
-        """AJAX requests should still work when count() fails on .extra() querysets."""
+    def test_annotation_count(self):
+        """Annotated columns are filtered and counted in a single COUNT query"""
 
         client = Client()
-        original_count = QuerySet.count
+        url = reverse("staff-list") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10"
+        with CaptureQueriesContext(connection) as queries:
+            payload = json.loads(client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
 
-        def count_with_extra_failure(queryset):
-            if getattr(queryset.query, "extra_select", None):
-                raise Exception("backend count failure")
-            return original_count(queryset)
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        # unused annotations are left out of the count
+        count_queries = [q['sql'] for q in queries if "COUNT(*)" in q['sql']]
+        self.assertTrue(count_queries)
+        self.assertFalse(any("CASE" in sql for sql in count_queries))
 
-        with mock.patch(
-            "django.db.models.query.QuerySet.count",
-            autospec=True,
-            side_effect=count_with_extra_failure,
-        ):
-            response = client.get(
-                reverse("staff-list") + "?sEcho=1&iColumns=8&sColumns="
-                "&iDisplayStart=0&iDisplayLength=10",
-                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
-            )
+        with CaptureQueriesContext(connection) as queries:
+            payload = json.loads(client.get(url + "&sSearch_7=a1", HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
 
-        self.assertEqual(response.status_code, 200)
-        payload = json.loads(response.content.decode('utf-8'))
-        total = Staff.objects.count()
-        self.assertEqual(payload['iTotalRecords'], total)
-        self.assertEqual(payload['iTotalDisplayRecords'], total)
+        expected = len([s for s in Staff.objects.all() if s.generic_object.name == "A1"])
+        self.assertEqual(payload['iTotalDisplayRecords'], expected)
+        self.assertEqual({row[7] for row in payload['aaData']}, {"A1"})
+        self.assertEqual(len([q for q in queries if "COUNT(*)" in q['sql'] and "CASE" in q['sql']]), 1)
+
+        # select options for annotated columns come from the database too
+        view = StaffList()
+        view.request = mock.Mock()
+        names = sorted({s.generic_object.name for s in Staff.objects.all()})
+        self.assertEqual(view.get_filters("genericname", queryset=Staff.objects.all()), [(n, n) for n in names])
+
+    def test_extra_select_filter_params(self):
+        """SELECT filters on extra select columns pass the values as query parameters"""
+
+        client = Client()
+        url = reverse("staff-list-no-generic") + "?sEcho=1&iColumns=2&iDisplayStart=0&iDisplayLength=10&sSearch_1="
+        extra = {"select": {"initial": "substr(last_name, 1, 1)"}}
+        with mock.patch("staff.views.StaffListNoGeneric.fields", ("id", "initial")), \
+                mock.patch("staff.views.StaffListNoGeneric.widgets", {"initial": liviews.SELECT}), \
+                mock.patch("staff.views.StaffListNoGeneric.get_extra", return_value=extra):
+            payload = json.loads(client.get(url + "O", HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
+            self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.filter(last_name__startswith="O").count())
+
+            payload = json.loads(client.get(url + "O') OR ('1'='1", HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
+            self.assertEqual(payload['iTotalDisplayRecords'], 0)
 
     def test_static_live_filters(self):
         """Fields listed in static_live_filters should return the declared
@@ -447,3 +491,1289 @@ class TestViews(TestCase):
             payload['liveFilters'][9],
             set(Staff.objects.filter(active=INACTIVE).values_list('contract_type__name', flat=True)),
         )
+
+    def _keyset_page(self, client, start, cursor=None, sort=""):
+        url = reverse("staff-list-keyset") + "?sEcho=1&iColumns=12&iDisplayStart={0}&iDisplayLength=10{1}".format(start, sort)
+        if cursor:
+            url += "&sCursor=" + cursor
+        response = client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_keyset_pagination_matches_offset_pages(self):
+        """Paging forwards and backwards with cursors should return the same
+        rows as offset pagination"""
+
+        client = Client()
+        sort = "&iSortingCols=1&iSortCol_0=1&sSortDir_0=desc"
+
+        offset_pages = [self._keyset_page(client, start, sort=sort) for start in (0, 10, 20)]
+        self.assertIsNone(offset_pages[0]['sPrevCursor'])
+        self.assertIsNotNone(offset_pages[0]['sNextCursor'])
+
+        page = offset_pages[0]
+        for idx in (1, 2):
+            page = self._keyset_page(client, idx * 10, cursor=page['sNextCursor'], sort=sort)
+            self.assertEqual(page['aaData'], offset_pages[idx]['aaData'])
+            self.assertEqual(page['iTotalDisplayRecords'], Staff.objects.count())
+
+        page = self._keyset_page(client, 10, cursor=page['sPrevCursor'], sort=sort)
+        self.assertEqual(page['aaData'], offset_pages[1]['aaData'])
+
+        page = self._keyset_page(client, 0, cursor=page['sPrevCursor'], sort=sort)
+        self.assertEqual(page['aaData'], offset_pages[0]['aaData'])
+        self.assertIsNone(page['sPrevCursor'])
+
+    def test_keyset_pagination_last_page(self):
+        """The last page should not have a next cursor"""
+
+        client = Client()
+        total = Staff.objects.count()
+        last_start = (total - 1) // 10 * 10
+        before_last = self._keyset_page(client, last_start - 10)
+        page = self._keyset_page(client, last_start, cursor=before_last['sNextCursor'])
+        self.assertEqual(len(page['aaData']), total - last_start)
+        self.assertIsNone(page['sNextCursor'])
+
+    def test_keyset_pagination_stale_cursor(self):
+        """A cursor created for a different ordering is ignored"""
+
+        client = Client()
+        first = self._keyset_page(client, 0)
+        sort = "&iSortingCols=1&iSortCol_0=0&sSortDir_0=asc"
+        page = self._keyset_page(client, 10, cursor=first['sNextCursor'], sort=sort)
+        pks = list(Staff.objects.order_by("pk").values_list("pk", flat=True)[10:20])
+        self.assertEqual([int(row[0]) for row in page['aaData']], pks)
+
+    def test_keyset_pagination_filter_changed(self):
+        """A cursor created before the filters changed is ignored"""
+
+        client = Client()
+        sort = "&iSortingCols=1&iSortCol_0=1&sSortDir_0=asc"
+        first = self._keyset_page(client, 0, sort=sort)
+        second = self._keyset_page(client, 10, cursor=first['sNextCursor'], sort=sort)
+
+        # DataTables goes back to the first page when a filter changes
+        page = self._keyset_page(client, 0, cursor=second['sPrevCursor'], sort=sort + "&sSearch_2=inactive")
+        self.assertEqual(page['iTotalDisplayRecords'], 7)
+        self.assertEqual(len(page['aaData']), 7)
+
+    def test_keyset_pagination_invalid_cursor_values(self):
+        """Cursor values that can't be converted fall back to offset pagination"""
+
+        client = Client()
+        first = self._keyset_page(client, 0)
+        cursor = utils.decode_cursor(first['sNextCursor'])
+        cursor["v"] = ["notanint"] * len(cursor["v"])
+
+        page = self._keyset_page(client, 10, cursor=utils.encode_cursor(cursor))
+        self.assertEqual(page['aaData'], self._keyset_page(client, 10)['aaData'])
+
+    def test_keyset_keys_nullable_relation(self):
+        """Fields reached through a nullable relation can't be used as keys"""
+
+        view = StaffList()
+        qs = Staff.objects.order_by("department__name")
+        self.assertIsNotNone(view.get_keyset_keys(qs))
+        with mock.patch.object(Staff._meta.get_field("department"), "null", True):
+            self.assertIsNone(view.get_keyset_keys(qs))
+
+    def test_keyset_pagination_unsupported_ordering(self):
+        """Ordering on the genericname annotation can't be used as a key so no cursors are returned"""
+
+        client = Client()
+        page = self._keyset_page(client, 0, sort="&iSortingCols=1&iSortCol_0=7&sSortDir_0=asc")
+        self.assertNotIn('sNextCursor', page)
+        self.assertEqual(len(page['aaData']), 10)
+
+    def _total_records(self, client):
+        response = client.get(
+            reverse("staff-list") + "?sEcho=1&iColumns=8&sColumns=&iDisplayStart=0&iDisplayLength=10",
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        return json.loads(response.content.decode('utf-8'))['iTotalRecords']
+
+    def test_cache_total_count(self):
+        """iTotalRecords should be cached across requests when cache_total_count is set"""
+
+        cache.clear()
+        client = Client()
+        total = Staff.objects.count()
+
+        with mock.patch("staff.views.StaffList.cache_total_count", True):
+            self.assertEqual(self._total_records(client), total)
+
+            # deleting without sending signals leaves the cached count in place
+            Staff.objects.filter(pk=Staff.objects.first().pk)._raw_delete(Staff.objects.db)
+            self.assertEqual(self._total_records(client), total)
+
+        # the cache is not used unless requested
+        self.assertEqual(self._total_records(client), total - 1)
+
+    def test_cache_total_count_invalidated_by_signals(self):
+        """Saving or deleting a model used by the queryset invalidates the cached count"""
+
+        cache.clear()
+        client = Client()
+        total = Staff.objects.count()
+
+        with mock.patch("staff.views.StaffList.cache_total_count", True):
+            self.assertEqual(self._total_records(client), total)
+            Staff.objects.first().delete()
+            self.assertEqual(self._total_records(client), total - 1)
+
+    def _disconnect_invalidation(self):
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+
+        post_save.disconnect(dispatch_uid="listable_post_save")
+        post_delete.disconnect(dispatch_uid="listable_post_delete")
+        m2m_changed.disconnect(dispatch_uid="listable_m2m_changed")
+
+    def _invalidation_connected(self):
+        from django.db.models.signals import post_save
+        return any(lookup_key[0] == "listable_post_save" for lookup_key, *__ in post_save.receivers)
+
+    def test_cache_invalidation_connected_on_use(self):
+        """The invalidation receivers are only connected once a view uses the cache"""
+
+        def reconnect():
+            self._disconnect_invalidation()
+            li_cache._invalidation_connected = False
+            li_cache.connect_invalidation()
+
+        self.addCleanup(reconnect)
+        self._disconnect_invalidation()
+
+        with mock.patch("listable.cache._invalidation_connected", False):
+            self._total_records(Client())
+            self.assertFalse(self._invalidation_connected())
+
+            with mock.patch("staff.views.StaffList.cache_total_count", True):
+                self._total_records(Client())
+            self.assertTrue(self._invalidation_connected())
+
+        self._disconnect_invalidation()
+        with mock.patch("listable.cache._invalidation_connected", False):
+            type("CachedStaffList", (StaffList,), {"cache_live_filters": True})
+            self.assertTrue(self._invalidation_connected())
+
+        self._disconnect_invalidation()
+        with mock.patch("listable.cache._invalidation_connected", False), \
+                mock.patch("listable.settings.LISTABLE_CACHE_INVALIDATION", False):
+            li_cache.connect_invalidation()
+            self.assertFalse(self._invalidation_connected())
+
+    def test_cache_invalidation_m2m_post_actions(self):
+        """Only the post_* m2m_changed actions invalidate cached values"""
+
+        with mock.patch("listable.cache.invalidate_model") as invalidate:
+            for action in ("pre_add", "pre_remove", "pre_clear"):
+                li_cache.invalidate_m2m(Staff, action=action)
+            invalidate.assert_not_called()
+            li_cache.invalidate_m2m(Staff, action="post_add")
+            invalidate.assert_called_once()
+
+    def _count_payload(self, client, start=0):
+        response = client.get(
+            reverse("staff-list") + "?sEcho=1&iColumns=8&sColumns=&iDisplayStart={0}&iDisplayLength=10".format(start),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_count_strategy_exact(self):
+        client = Client()
+        payload = self._count_payload(client)
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        self.assertEqual(payload['sCountType'], liviews.COUNT_EXACT)
+
+    def test_count_strategy_estimate_unsupported_backend(self):
+        """SQLite doesn't provide a row estimate so an exact count is used"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_ESTIMATE):
+            payload = self._count_payload(client)
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        self.assertEqual(payload['sCountType'], liviews.COUNT_EXACT)
+
+    def test_count_strategy_estimate(self):
+        """Estimated counts are reported as such and don't truncate pages"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_ESTIMATE), \
+                mock.patch("listable.utils.estimate_count", return_value=15):
+            payload = self._count_payload(client, start=20)
+
+        self.assertEqual(payload['iTotalDisplayRecords'], 15)
+        self.assertEqual(payload['sCountType'], liviews.COUNT_ESTIMATE)
+        self.assertEqual(len(payload['aaData']), 10)
+
+    def test_count_strategy_hybrid(self):
+        """Hybrid counting uses an exact count below the threshold"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_HYBRID), \
+                mock.patch("listable.utils.estimate_count", return_value=150):
+            payload = self._count_payload(client)
+            self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+            self.assertEqual(payload['sCountType'], liviews.COUNT_EXACT)
+
+            with mock.patch("staff.views.StaffList.count_estimate_threshold", 100):
+                payload = self._count_payload(client)
+            self.assertEqual(payload['iTotalDisplayRecords'], 150)
+            self.assertEqual(payload['sCountType'], liviews.COUNT_ESTIMATE)
+
+    def test_count_strategy_capped(self):
+        """Capped counts report cap + 1 when there are more records than the cap"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_CAPPED), \
+                mock.patch("staff.views.StaffList.count_cap", 50):
+            payload = self._count_payload(client)
+            self.assertEqual(payload['iTotalDisplayRecords'], 51)
+            self.assertEqual(payload['sCountType'], liviews.COUNT_CAPPED)
+
+            # requesting a page past the cap extends it
+            payload = self._count_payload(client, start=100)
+            self.assertEqual(payload['iTotalDisplayRecords'], 111)
+            self.assertEqual(len(payload['aaData']), 10)
+
+    def test_count_strategy_capped_below_cap(self):
+        """Counts below the cap are exact"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_CAPPED):
+            payload = self._count_payload(client)
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        self.assertEqual(payload['sCountType'], liviews.COUNT_EXACT)
+
+    def _no_generic_payload(self, client, start=0, query=""):
+        response = client.get(
+            reverse("staff-list-no-generic") +
+            "?sEcho=1&iColumns=11&sColumns=&iDisplayStart={0}&iDisplayLength=10{1}".format(start, query),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_count_strategy_window(self):
+        """The window count strategy fetches the page and count in one query"""
+
+        client = Client()
+        expected = self._no_generic_payload(client, start=25)
+
+        with mock.patch("staff.views.StaffListNoGeneric.count_strategy", liviews.COUNT_WINDOW):
+            with CaptureQueriesContext(connection) as queries:
+                payload = self._no_generic_payload(client, start=25)
+
+        self.assertEqual(payload['aaData'], expected['aaData'])
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        self.assertEqual(payload['sCountType'], liviews.COUNT_EXACT)
+        self.assertEqual(len([q for q in queries if "OVER" in q['sql']]), 1)
+        self.assertEqual(len([q for q in queries if "COUNT(*) AS" in q['sql']]), 1)
+
+    def test_count_strategy_window_empty(self):
+        """Empty pages fall back to an exact count"""
+
+        client = Client()
+        query = "&sSearch_1=nobodyhasthisname"
+        with mock.patch("staff.views.StaffListNoGeneric.count_strategy", liviews.COUNT_WINDOW):
+            payload = self._no_generic_payload(client, query=query)
+        self.assertEqual(payload['aaData'], [])
+        self.assertEqual(payload['iTotalDisplayRecords'], 0)
+
+    def test_count_strategy_window_extra(self):
+        """Views using get_extra fall back to an exact count"""
+
+        client = Client()
+        extra = {"select": {"initial": "substr(last_name, 1, 1)"}}
+        with mock.patch("staff.views.StaffList.count_strategy", liviews.COUNT_WINDOW), \
+                mock.patch("staff.views.StaffList.get_extra", return_value=extra):
+            payload = self._count_payload(client)
+        self.assertEqual(payload['iTotalDisplayRecords'], Staff.objects.count())
+        self.assertEqual(len(payload['aaData']), 10)
+
+    def test_deferred_join(self):
+        """Deferred join paging should return the same rows as regular paging"""
+
+        client = Client()
+        for sort_col in (0, 1, 5):
+            sort = "&iSortingCols=1&iSortCol_0={0}&sSortDir_0=desc".format(sort_col)
+            expected = self._keyset_page(client, 30, sort=sort)
+            with mock.patch("staff.views.StaffListKeyset.deferred_join", True):
+                payload = self._keyset_page(client, 30, sort=sort)
+                self.assertEqual(payload['aaData'], expected['aaData'])
+
+                # keyset pages are loaded the same way
+                next_page = self._keyset_page(client, 40, cursor=payload['sNextCursor'], sort=sort)
+            self.assertEqual(next_page['aaData'], self._keyset_page(client, 40, sort=sort)['aaData'])
+
+    def test_deferred_join_extra_ordering(self):
+        """Ordering on the genericname annotation works with deferred join paging"""
+
+        client = Client()
+        sort = "&iSortingCols=1&iSortCol_0=7&sSortDir_0=desc"
+        with mock.patch("staff.views.StaffListKeyset.deferred_join", True):
+            payload = self._keyset_page(client, 0, sort=sort)
+        names = [row[7] for row in payload['aaData']]
+        self.assertEqual(len(names), 10)
+        self.assertEqual(names, sorted(names, reverse=True))
+
+    def test_deferred_join_narrow_page_query(self):
+        """The page query only selects primary keys"""
+
+        client = Client()
+        with mock.patch("staff.views.StaffListNoGeneric.deferred_join", True):
+            with CaptureQueriesContext(connection) as queries:
+                payload = self._no_generic_payload(client, start=50, query="&iSortingCols=1&iSortCol_0=3&sSortDir_0=asc")
+
+        self.assertEqual(len(payload['aaData']), 10)
+        page_query = [q['sql'] for q in queries if "OFFSET 50" in q['sql']][0]
+        self.assertTrue(page_query.startswith('SELECT "staff_staff"."id" AS "pk" FROM'))
+        self.assertNotIn('"staff_position"', page_query)
+
+    def _live_filters(self, client, query=""):
+        url = reverse("staff-list-live-filters") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10" + query
+        response = client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content.decode('utf-8'))['liveFilters']
+
+    def test_live_filters_union(self):
+        """A single UNION ALL query returns the same live filters as one query per column"""
+
+        client = Client()
+        for query in ("", "&sSearch_2=inactive", "&sSearch_9=%5E(Other%60%7C%60Part%2520Time%2520Contract)%24"):
+            expected = self._live_filters(client, query)
+            with mock.patch("staff.views.StaffListLiveFilters.live_filters_union", True):
+                with CaptureQueriesContext(connection) as queries:
+                    live_filters = self._live_filters(client, query)
+
+            self.assertEqual(len(live_filters), len(expected))
+            for values, expected_values in zip(live_filters, expected):
+                if expected_values is None:
+                    self.assertIsNone(values)
+                else:
+                    self.assertCountEqual(values, expected_values)
+
+            self.assertEqual(len([q for q in queries if "UNION ALL" in q['sql']]), 1)
+            self.assertEqual(len([q for q in queries if "SELECT DISTINCT" in q['sql']]), 1)
+
+    def test_cache_live_filters(self):
+        """Paging through a filtered table should not require any live filter queries"""
+
+        cache.clear()
+        client = Client()
+        query = "&sSearch_2=inactive"
+        expected = self._live_filters(client, query)
+
+        for union in (False, True):
+            cache.clear()
+            with mock.patch("staff.views.StaffListLiveFilters.cache_live_filters", True), \
+                    mock.patch("staff.views.StaffListLiveFilters.live_filters_union", union):
+                self.assertEqual(self._live_filters(client, query), expected)
+
+                with CaptureQueriesContext(connection) as queries:
+                    live_filters = self._live_filters(client, query + "&iSortingCols=1&iSortCol_0=1&sSortDir_0=asc")
+
+            self.assertEqual(live_filters, expected)
+            self.assertEqual(len([q for q in queries if "DISTINCT" in q['sql']]), 0)
+
+    def test_cache_live_filters_other_columns(self):
+        """Changing the filter on one column only recomputes the other columns"""
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffListLiveFilters.cache_live_filters", True):
+            self._live_filters(client)
+            with CaptureQueriesContext(connection) as queries:
+                live_filters = self._live_filters(client, "&sSearch_2=inactive")
+
+        # every live filter column except active itself is affected by the active filter
+        self.assertEqual(len([q for q in queries if "DISTINCT" in q['sql']]), 5)
+        self.assertEqual(len(live_filters[9]), Staff.objects.filter(active=INACTIVE).values("contract_type").distinct().count())
+
+    def test_cache_live_filters_related_invalidation(self):
+        """Renaming a related object invalidates the cached live filter values"""
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffListLiveFilters.cache_live_filters", True):
+            self._live_filters(client)
+            position = Staff.objects.first().position
+            position.name = "Renamed Position"
+            position.save()
+            live_filters = self._live_filters(client)
+
+        self.assertIn("Renamed Position", live_filters[4])
+
+    def test_cache_filter_options(self):
+        """Select options rendered by the template tag are cached across page loads"""
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffList.cache_filter_options", True):
+            expected = client.get(reverse("staff-list")).content
+            with CaptureQueriesContext(connection) as queries:
+                content = client.get(reverse("staff-list")).content
+
+        self.assertEqual(content, expected)
+        self.assertEqual(len([q for q in queries if "DISTINCT" in q['sql'] or "GROUP BY" in q['sql']]), 0)
+
+    def test_cache_filter_options_invalidated_by_signals(self):
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffList.cache_filter_options", True):
+            client.get(reverse("staff-list"))
+            position = Staff.objects.first().position
+            position.name = "Renamed Position"
+            position.save()
+            content = client.get(reverse("staff-list")).content.decode("utf-8")
+
+        self.assertIn("Renamed Position", content)
+
+    def test_cache_filter_options_annotation_invalidated(self):
+        """Cached options of an annotation column depend on the models used by its subqueries"""
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffList.cache_filter_options", True), \
+                mock.patch.dict("staff.views.StaffList.widgets", {"genericname": liviews.SELECT}):
+            client.get(reverse("staff-list"))
+            generic = GenericModelA.objects.get(name="A1")
+            generic.name = "Renamed A1"
+            generic.save()
+            content = client.get(reverse("staff-list")).content.decode("utf-8")
+
+        self.assertIn("Renamed A1", content)
+
+    def test_cache_filter_options_scope(self):
+        """get_cache_scope partitions the cached select options"""
+
+        cache.clear()
+        client = Client()
+        with mock.patch("staff.views.StaffList.cache_filter_options", True):
+            client.get(reverse("staff-list"))
+            with mock.patch("staff.views.StaffList.get_cache_scope", return_value="other"):
+                with CaptureQueriesContext(connection) as queries:
+                    client.get(reverse("staff-list"))
+
+        self.assertGreater(len([q for q in queries if "DISTINCT" in q['sql'] or "GROUP BY" in q['sql']]), 0)
+
+    def _ajax_options(self, client, col, page=1, search=""):
+        url = reverse("staff-list-ajax-options") + "?iOptionsColumn=%d&iOptionsPage=%d&sOptionsSearch=%s" % (col, page, search)
+        return client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_ajax_options_not_embedded(self):
+        """Columns in ajax_options are rendered without any option values"""
+
+        resp = self.client.get(reverse("staff-list-ajax-options"))
+        opts = resp.content.decode("utf-8").split("var Listable = ")[1].split(";</script>")[0]
+        filter_defs = json.loads(opts)["columnFilterDefs"]
+
+        self.assertEqual(filter_defs[4], {"type": "select", "values": [], "ajaxOptions": True, "label": "-----"})
+        self.assertEqual(filter_defs[9], {"type": "select", "values": [], "ajaxOptions": True, "multiple": "multiple"})
+        self.assertTrue(filter_defs[5]["values"])
+        self.assertNotIn("ajaxOptions", filter_defs[5])
+
+    def test_ajax_options_pages(self):
+        client = Client()
+        options = []
+        page = 1
+        while True:
+            payload = json.loads(self._ajax_options(client, 4, page=page).content.decode("utf-8"))
+            self.assertLessEqual(len(payload["aaOptions"]), 2)
+            options.extend(o["value"] for o in payload["aaOptions"])
+            if not payload["bMore"]:
+                break
+            page += 1
+
+        expected = list(Staff.objects.order_by("position__name").values_list("position__name", flat=True).distinct())
+        self.assertGreater(page, 1)
+        self.assertEqual(options, [escape(o) for o in expected])
+
+    def test_ajax_options_search(self):
+        name = Staff.objects.first().position.name
+        search = name[1:4]
+        payload = json.loads(self._ajax_options(Client(), 4, search=search).content.decode("utf-8"))
+
+        expected = Staff.objects.filter(position__name__icontains=search).values_list("position__name", flat=True)
+        self.assertTrue(payload["aaOptions"])
+        self.assertTrue(all(search.lower() in o["label"].lower() for o in payload["aaOptions"]))
+        self.assertEqual(payload["bMore"], len(set(expected)) > 2)
+
+    def test_ajax_options_invalid_column(self):
+        client = Client()
+        # department__name is a text filter and not in ajax_options
+        self.assertEqual(self._ajax_options(client, 3).status_code, 404)
+        self.assertEqual(self._ajax_options(client, 100).status_code, 404)
+
+    def test_column_plan_rows(self):
+        """Rows rendered by the compiled column plans match formatting each cell individually"""
+
+        view = StaffListNoGeneric()
+        view.request = mock.Mock()
+        objects = list(Staff.objects.select_related("department__business", "position", "contract_type")[:20])
+        fields = view.get_fields()
+
+        rows = view.get_rows(objects)
+
+        self.assertEqual(rows, [[view.format_col(field, obj) for field in fields] for obj in objects])
+        self.assertEqual(rows[0][2], dict(Staff._meta.get_field("active").flatchoices)[objects[0].active])
+
+    def test_column_plan_cached_per_class(self):
+        fields = StaffList.fields
+        plan = StaffList.get_column_plan(Staff, fields)
+
+        self.assertIs(StaffList.get_column_plan(Staff, fields), plan)
+        self.assertIsNot(StaffListNoGeneric.get_column_plan(Staff, fields), plan)
+        self.assertEqual([p.kind for p in plan[:4]], [liviews.RENDER_ATTR, liviews.RENDER_FORMATTER, liviews.RENDER_CHOICES, liviews.RENDER_RELATED])
+
+    def test_format_col_override(self):
+        """Subclasses overriding format_col are still called for every cell"""
+
+        class View(StaffListNoGeneric):
+            def format_col(self, field, obj):
+                return "x"
+
+        view = View()
+        view.request = mock.Mock()
+        self.assertEqual(view.get_rows(Staff.objects.all()[:2]), [["x"] * len(view.fields)] * 2)
+
+    def test_widgets_not_mutated(self):
+        widgets = dict(StaffList.widgets)
+        self._no_generic_payload(Client())
+        self.client.get(reverse("staff-list"), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(StaffList.widgets, widgets)
+        self.assertNotIn("id", StaffList.widgets)
+
+    def _projection_payload(self, client, query="", **attrs):
+        fields = tuple(f for f in StaffList.fields if f != "name")
+        url = reverse("staff-list") + "?sEcho=1&iColumns=11&iDisplayStart=10&iDisplayLength=10" + query
+        with mock.patch("staff.views.StaffList.fields", fields), \
+                mock.patch.multiple("staff.views.StaffList", **attrs):
+            with mock.patch("staff.models.Staff.__init__", side_effect=AssertionError):
+                try:
+                    response = client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                except AssertionError:
+                    return None
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_values_projection(self):
+        """Rows are fetched with values_list when every column is a field path"""
+
+        client = Client()
+        for attrs in ({}, {"deferred_join": True}, {"count_strategy": liviews.COUNT_WINDOW}):
+            # model instances are created without projection
+            self.assertIsNone(self._projection_payload(client, values_projection=False, **attrs))
+
+            payload = self._projection_payload(client, values_projection=True, **attrs)
+            self.assertIsNotNone(payload)
+            self.assertEqual(len(payload["aaData"]), 10)
+
+    def test_values_projection_matches_instances(self):
+        fields = tuple(f for f in StaffList.fields if f != "name")
+        url = reverse("staff-list") + "?sEcho=1&iColumns=11&iDisplayStart=0&iDisplayLength=25&iSortingCols=1&iSortCol_0=0"
+        payloads = []
+        for projection in (False, True):
+            with mock.patch("staff.views.StaffList.fields", fields), \
+                    mock.patch("staff.views.StaffList.values_projection", projection):
+                response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            payloads.append(json.loads(response.content.decode('utf-8'))["aaData"])
+
+        self.assertEqual(payloads[0], payloads[1])
+
+    def test_values_projection_keyset(self):
+        fields = tuple(f for f in StaffList.fields if f != "name")
+        with mock.patch("staff.views.StaffList.fields", fields), \
+                mock.patch("staff.views.StaffListKeyset.values_projection", True):
+            first = self._keyset_page(self.client, 0)
+            second = self._keyset_page(self.client, 10, cursor=first["sNextCursor"])
+
+        self.assertTrue(second["aaData"])
+        self.assertNotEqual(first["aaData"], second["aaData"])
+
+    def test_values_projection_formatter_fallback(self):
+        """A formatter column needs model instances so projection isn't used"""
+
+        view = StaffListNoGeneric()
+        view.request = mock.Mock()
+        with mock.patch("staff.views.StaffListNoGeneric.values_projection", True):
+            self.assertIsNone(view.get_projection(Staff.objects.all()))
+            with mock.patch("staff.views.StaffListNoGeneric.fields", ("id", "active", "position__name")):
+                self.assertEqual(view.get_projection(Staff.objects.all()), ["id", "active", "position__name"])
+
+    def test_defer_inferred_query_fields(self):
+        """select_related & only() are inferred from the columns"""
+
+        view = StaffList()
+        view.request = mock.Mock()
+        qs = view.annotate_queryset(Staff.objects.all())
+        query_fields = view.get_query_fields(qs)
+
+        self.assertCountEqual(query_fields.select_related, ["department", "position", "department__business", "contract_type"])
+        # name is a formatter using the fields from its order_fields & search_fields
+        self.assertCountEqual(query_fields.only, [
+            "id", "last_name", "first_name", "active", "department__name", "position__name",
+            "department__business__name", "department__business__business_type", "is_manager",
+            "contract_type__name", "date_hired", "last_incident",
+        ])
+
+    def test_defer_fields(self):
+        view = StaffListNoGeneric()
+        view.request = mock.Mock()
+        qs = Staff.objects.all()
+
+        with mock.patch("staff.views.StaffListNoGeneric.defer_fields", {"name": ("first_name",)}):
+            only = view.get_query_fields(qs).only
+        self.assertIn("first_name", only)
+        self.assertNotIn("last_name", only)
+
+        with mock.patch("staff.views.StaffListNoGeneric.defer_fields", {"name": None}):
+            self.assertIsNone(view.get_query_fields(qs).only)
+
+        # a model method can't be inferred
+        with mock.patch("staff.views.StaffListNoGeneric.fields", ("id", "status")):
+            self.assertIsNone(view.get_query_fields(qs).only)
+
+        # an already restricted queryset is left alone
+        self.assertIsNone(view.get_query_fields(qs.only("id")).only)
+
+    def test_defer_page_queries(self):
+        """With defer and no select_related the page is still loaded in a single query"""
+
+        url = reverse("staff-list") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10"
+        payloads = []
+        for defer in (False, True):
+            with mock.patch("staff.views.StaffList.defer", defer), \
+                    mock.patch("staff.views.StaffList.select_related", () if defer else StaffList.select_related):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            payloads.append(json.loads(response.content.decode('utf-8'))["aaData"])
+
+        self.assertEqual(payloads[0], payloads[1])
+        page_query = [q['sql'] for q in queries if "COUNT(*)" not in q['sql']][-1]
+        self.assertIn('"staff_business"."name"', page_query)
+        # object_id is only used by the genericname subqueries
+        self.assertNotIn('"staff_staff"."object_id",', page_query)
+        self.assertEqual(len([q for q in queries if 'FROM "staff_staff"' not in q['sql']]), 0)
+
+    def test_multi_column_prefetch(self):
+        """SELECT_MULTI_FROM_MULTI columns are prefetched in a fixed number of queries"""
+
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=10"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        payload = json.loads(response.content.decode('utf-8'))
+
+        staff_queries = [q['sql'] for q in queries if 'FROM "staff_staff"' in q['sql']]
+        self.assertEqual(len(staff_queries), 1)
+        # only the displayed field & the generic relation fields are loaded
+        self.assertNotIn('"staff_staff"."first_name"', staff_queries[0].split(" FROM ")[0])
+
+        for row in payload["aaData"]:
+            obj = GenericModelA.objects.get(pk=row[0])
+            self.assertCountEqual(row[2].split(", ") if row[2] else [], [escape(s.last_name) for s in obj.staff.all()])
+
+    def test_multi_column_prefetch_declared(self):
+        """A declared prefetch_related for the relation is used as is"""
+
+        from staff.views import GenericModelAList
+
+        view = GenericModelAList()
+        view.request = mock.Mock()
+        self.assertEqual([p.prefetch_to for p in view.get_prefetch_related(GenericModelA)], ["staff"])
+        with mock.patch("staff.views.GenericModelAList.prefetch_related", ("staff",)):
+            self.assertEqual(view.get_prefetch_related(GenericModelA), ["staff"])
+
+    def test_exists_filters(self):
+        """Filters on to-many relations use EXISTS rather than DISTINCT"""
+
+        from urllib.parse import quote
+
+        names = list(Staff.objects.order_by("last_name").values_list("last_name", flat=True)[:20])
+        search = quote("^(" + "`|`".join(quote(n) for n in names) + ")$")
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=100&sSearch_2=" + search
+        expected = GenericModelA.objects.filter(staff__last_name__in=names).distinct()
+        self.assertTrue(expected.count() < GenericModelA.objects.filter(staff__last_name__in=names).count())
+
+        for exists in (True, False):
+            with mock.patch("staff.views.GenericModelAList.exists_filters", exists), \
+                    mock.patch("staff.views.GenericModelAList.live_filters", True):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            payload = json.loads(response.content.decode('utf-8'))
+
+            self.assertEqual(payload["iTotalDisplayRecords"], expected.count())
+            self.assertCountEqual([row[0] for row in payload["aaData"]], [str(pk) for pk in expected.values_list("pk", flat=True)])
+            # the live filter values are still DISTINCT but the count & page queries aren't
+            distinct_queries = [
+                q['sql'] for q in queries
+                if "DISTINCT" in q['sql'] and 'AS "staff__last_name"' not in q['sql']
+            ]
+            if exists:
+                self.assertTrue(any("EXISTS" in q['sql'] for q in queries))
+                self.assertFalse(distinct_queries)
+            else:
+                self.assertTrue(distinct_queries)
+
+    def test_exists_filters_annotation(self):
+        """EXISTS filters can refer to the queryset's annotations"""
+
+        from django.db.models.functions import Upper
+
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=100&sSearch_1="
+        expected = None
+        for exists in (False, True):
+            with mock.patch("staff.views.GenericModelAList.exists_filters", exists), \
+                    mock.patch("staff.views.GenericModelAList.annotations", {"upper_name": Upper("name")}), \
+                    mock.patch("staff.views.GenericModelAList.search_fields", {
+                        "name": ("upper_name__icontains", "staff__last_name__icontains"),
+                    }):
+                response = self.client.get(url + "a1", HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(response.status_code, 200)
+            payload = json.loads(response.content.decode('utf-8'))
+            self.assertTrue(payload["aaData"])
+            if expected is not None:
+                self.assertEqual(payload["aaData"], expected)
+            expected = payload["aaData"]
+
+    def test_exists_filters_cache_invalidation(self):
+        """Cached live filters depend on the models used by EXISTS subqueries"""
+
+        from urllib.parse import quote
+
+        cache.clear()
+        staff = Staff.objects.filter(object_id__isnull=False).order_by("pk").first()
+        staff.last_name = "Unique Last Name"
+        staff.save()
+
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=100&sSearch_2="
+        url += quote("^(" + quote(staff.last_name) + ")$")
+        attrs = {
+            "exists_filters": True,
+            "live_filters": True,
+            "cache_live_filters": True,
+            "widgets": {"name": liviews.SELECT, "staff__last_name": liviews.SELECT_MULTI_FROM_MULTI},
+        }
+        with mock.patch.multiple("staff.views.GenericModelAList", **attrs):
+            payload = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
+            self.assertEqual(len(payload["aaData"]), 1)
+            self.assertEqual(payload["liveFilters"][1], [payload["aaData"][0][1]])
+
+            staff.last_name = "Renamed"
+            staff.save()
+            payload = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
+            self.assertEqual(payload["aaData"], [])
+            self.assertEqual(payload["liveFilters"][1], [])
+
+    def _selection_payload(self, url, values, field_idx, threshold=2):
+        from urllib.parse import quote
+
+        search = quote("^(" + "`|`".join(quote(v) for v in values) + ")$")
+        with mock.patch("listable.views.BaseListableView.large_selection_threshold", threshold):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url + "&sSearch_%d=%s" % (field_idx, search), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return json.loads(response.content.decode('utf-8')), [q['sql'] for q in queries]
+
+    def test_large_selection(self):
+        """Large SELECT_MULTI selections drop, invert or bind the filter as one parameter"""
+
+        url = reverse("staff-list") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10"
+        names = list(Staff.objects.order_by("contract_type__name").values_list("contract_type__name", flat=True).distinct())
+
+        def count_sql(queries):
+            # the filtered count precedes the unfiltered (iTotalRecords) count
+            return [sql for sql in queries if "COUNT(*)" in sql][0]
+
+        # everything selected
+        payload, queries = self._selection_payload(url, names, 9)
+        self.assertEqual(payload["iTotalDisplayRecords"], Staff.objects.count())
+        self.assertNotIn("staff_contracttype", count_sql(queries))
+
+        # all but one selected
+        payload, queries = self._selection_payload(url, names[1:], 9)
+        self.assertEqual(payload["iTotalDisplayRecords"], Staff.objects.exclude(contract_type__name=names[0]).count())
+        self.assertIn("NOT", count_sql(queries))
+
+        # the same number of values without a large selection
+        payload, queries = self._selection_payload(url, names[:3], 9, threshold=100)
+        expected = Staff.objects.filter(contract_type__name__in=names[:3]).count()
+        self.assertEqual(payload["iTotalDisplayRecords"], expected)
+        self.assertNotIn("json_each", count_sql(queries))
+
+        payload, queries = self._selection_payload(url, names[:3], 9)
+        self.assertEqual(payload["iTotalDisplayRecords"], expected)
+        self.assertIn("json_each", count_sql(queries))
+
+    def test_large_selection_cached(self):
+        """The distinct values of a large selection are cached with cache_filter_options"""
+
+        url = reverse("staff-list") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10"
+        names = list(Staff.objects.order_by("contract_type__name").values_list("contract_type__name", flat=True).distinct())
+
+        def distinct_sql(queries):
+            return [sql for sql in queries if "SELECT DISTINCT" in sql and "COUNT" not in sql]
+
+        cache.clear()
+        with mock.patch("staff.views.StaffList.cache_filter_options", True):
+            payload, queries = self._selection_payload(url, names[1:], 9)
+            self.assertEqual(len(distinct_sql(queries)), 1)
+
+            payload, queries = self._selection_payload(url, names[1:], 9)
+            self.assertEqual(distinct_sql(queries), [])
+            self.assertEqual(payload["iTotalDisplayRecords"], Staff.objects.exclude(contract_type__name=names[0]).count())
+
+            # saving a contract type invalidates the cached values
+            contract_type = ContractType.objects.get(name=names[0])
+            contract_type.name = names[0] + " renamed"
+            contract_type.save()
+            payload, queries = self._selection_payload(url, names[1:], 9)
+            self.assertEqual(len(distinct_sql(queries)), 1)
+
+    def test_large_selection_to_many(self):
+        """Selections on to-many columns are never inverted"""
+
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=100"
+        names = list(Staff.objects.order_by().values_list("last_name", flat=True).distinct())
+
+        payload, queries = self._selection_payload(url, names[1:], 2)
+        expected = GenericModelA.objects.filter(staff__last_name__in=names[1:]).distinct()
+        self.assertEqual(payload["iTotalDisplayRecords"], expected.count())
+        self.assertFalse([sql for sql in queries if "NOT" in sql])
+
+    def _streamed_payload(self, url, **patches):
+        with mock.patch.multiple("staff.views.StaffListNoGeneric", streaming=True, streaming_chunk_size=7, **patches):
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertTrue(response.streaming)
+            # rows are only formatted as the content is consumed
+            return json.loads(b"".join(response.streaming_content).decode('utf-8'))
+
+    def test_streaming(self):
+        """Streamed responses contain the same rows as a regular response"""
+
+        total = Staff.objects.count()
+        url = reverse("staff-list-no-generic") + "?sEcho=3&iColumns=11&iDisplayStart=0&iSortingCols=1&iSortCol_0=0&sSortDir_0=desc"
+        expected = json.loads(self.client.get(
+            url + "&iDisplayLength=%d" % total, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        ).content.decode('utf-8'))
+        self.assertEqual(len(expected["aaData"]), total)
+
+        for patches in ({}, {"deferred_join": True}, {"values_projection": True, "fields": ("id", "active", "position__name")}):
+            payload = self._streamed_payload(url + "&iDisplayLength=-1", **patches)
+            self.assertEqual(payload["iTotalDisplayRecords"], total)
+            self.assertEqual(payload["sEcho"], 3)
+            if "fields" in patches:
+                self.assertEqual(payload["aaData"], [[row[0], row[2], row[4]] for row in expected["aaData"]])
+            else:
+                self.assertEqual(payload["aaData"], expected["aaData"])
+
+        # pages below streaming_page_size use a regular response
+        with mock.patch("staff.views.StaffListNoGeneric.streaming", True):
+            response = self.client.get(url + "&iDisplayLength=10", HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertFalse(response.streaming)
+
+    def test_streaming_prefetch(self):
+        """Streamed pages prefetch SELECT_MULTI_FROM_MULTI columns a chunk at a time on any Django version"""
+
+        url = reverse("generic-a-list") + "?sEcho=1&iColumns=3&iDisplayStart=0&iDisplayLength=-1"
+        expected = json.loads(self.client.get(
+            url.replace("-1", "100"), HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        ).content.decode('utf-8'))
+
+        for version in (django.VERSION, (3, 2, 0, "final", 0)):
+            with mock.patch.multiple("staff.views.GenericModelAList", streaming=True, streaming_chunk_size=2), \
+                    mock.patch("django.VERSION", version):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                    payload = json.loads(b"".join(response.streaming_content).decode('utf-8'))
+
+            self.assertEqual(payload["aaData"], expected["aaData"])
+            # one prefetch query per chunk rather than one per row
+            chunks = -(-GenericModelA.objects.count() // 2)
+            self.assertLessEqual(len([q for q in queries if 'FROM "staff_staff"' in q['sql']]), chunks)
+
+    def test_streaming_page(self):
+
+        url = reverse("staff-list-no-generic") + "?sEcho=1&iColumns=11&iDisplayStart=40&iDisplayLength=20"
+        expected = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))
+        payload = self._streamed_payload(url, streaming_page_size=20, live_filters=True)
+        self.assertEqual(payload["aaData"], expected["aaData"])
+        self.assertIn("liveFilters", payload)
+
+    @skipUnless(orjson, "orjson is not installed")
+    def test_json_encoder(self):
+        """The ajax response is the same whichever LISTABLE_JSON_ENCODER is used"""
+
+        url = reverse("staff-list-live-filters") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=50"
+        payloads = []
+        for encoder in ("json", "orjson"):
+            with mock.patch("listable.settings.LISTABLE_JSON_ENCODER", encoder):
+                response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            payloads.append(json.loads(response.content.decode('utf-8')))
+
+        self.assertEqual(payloads[0], payloads[1])
+        self.assertEqual(len(payloads[0]["aaData"]), 50)
+
+    def test_json_encoder_benchmark(self):
+        from io import StringIO
+
+        from django.core.management import call_command
+
+        out = StringIO()
+        call_command("benchmark_json", rows=20, number=1, stdout=out)
+        self.assertIn("20 rows", out.getvalue())
+        self.assertIn("orjson", out.getvalue())
+
+    def _export(self, query, cookie=None, **patches):
+        from urllib.parse import quote
+
+        client = Client()
+        if cookie is not None:
+            client.cookies["dt-None_listable-table-staff-list-no-generic_"] = quote(json.dumps(cookie))
+
+        url = reverse("staff-list-no-generic") + "?" + query
+        patches = dict({"export_formats": ("csv", "ndjson")}, **patches)
+        with mock.patch.multiple("staff.views.StaffListNoGeneric", **patches):
+            response = client.get(url)
+            if not response.streaming:
+                return response, None
+            return response, b"".join(response.streaming_content).decode('utf-8')
+
+    def test_export_csv(self):
+        """Exports contain every row matching the current filters & ordering, unescaped"""
+
+        import csv
+        import io
+
+        query = "iSortingCols=1&iSortCol_0=0&sSortDir_0=desc&sSearch_1=an"
+        expected = json.loads(self.client.get(
+            reverse("staff-list-no-generic") + "?sEcho=1&iColumns=11&iDisplayStart=0&iDisplayLength=1000&" + query,
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        ).content.decode('utf-8'))["aaData"]
+        self.assertTrue(10 < len(expected) < Staff.objects.count())
+
+        response, content = self._export(query + "&sExport=csv", streaming_chunk_size=7)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        self.assertIn('filename="staff.csv"', response["Content-Disposition"])
+
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0][:3], ["Id", "Name", "Active"])
+        self.assertEqual(rows[1:], [[unescape(value) for value in row] for row in expected])
+
+    def test_export_ndjson_cookie_state(self):
+        """The sticky filter & sort state stored in the DataTables cookie is applied to exports"""
+
+        cookie = {
+            "aoSearchCols": [{"sSearch": ""}, {"sSearch": "ab"}] + [{"sSearch": ""}] * 9,
+            "aaSorting": [[0, "asc", 0]],
+            "iLength": 10, "iStart": 0, "iEnd": 10,
+        }
+        response, content = self._export("sExport=ndjson", cookie=cookie)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+
+        rows = [json.loads(line) for line in content.splitlines()]
+        expected = Staff.objects.filter(Q(first_name__icontains="ab") | Q(last_name__icontains="ab")).order_by("pk")
+        self.assertEqual([row["Id"] for row in rows], [str(pk) for pk in expected.values_list("pk", flat=True)])
+        self.assertEqual(rows[0]["Name"], expected[0].name())
+
+    @skipUnless(openpyxl, "openpyxl is not installed")
+    def test_export_xlsx(self):
+        import io
+
+        query = "iSortingCols=1&iSortCol_0=0&sSortDir_0=desc&sSearch_1=an"
+        expected = json.loads(self.client.get(
+            reverse("staff-list-no-generic") + "?sEcho=1&iColumns=11&iDisplayStart=0&iDisplayLength=1000&" + query,
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        ).content.decode('utf-8'))["aaData"]
+
+        url = reverse("staff-list-no-generic") + "?sExport=xlsx&" + query
+        with mock.patch.multiple("staff.views.StaffListNoGeneric", export_formats=("xlsx",), streaming_chunk_size=7):
+            response = self.client.get(url)
+            content = b"".join(response.streaming_content)
+        self.assertIn('filename="staff.xlsx"', response["Content-Disposition"])
+
+        sheet = openpyxl.load_workbook(io.BytesIO(content), read_only=True).active
+        rows = list(sheet.iter_rows(values_only=True))
+        self.assertEqual(list(rows[0][:3]), ["Id", "Name", "Active"])
+        self.assertEqual(len(rows) - 1, len(expected))
+        self.assertEqual([str(row[0]) for row in rows[1:]], [row[0] for row in expected])
+        self.assertEqual([row[1] for row in rows[1:]], [unescape(row[1]) for row in expected])
+
+    def test_export_formats(self):
+
+        response, __ = self._export("sExport=pdf")
+        self.assertEqual(response.status_code, 404)
+
+        with mock.patch.dict(sys.modules, {"openpyxl": None}):
+            with self.assertRaises(ImproperlyConfigured):
+                self._export("sExport=xlsx", export_formats=("xlsx",))
+
+    def test_batch_formatter(self):
+        """format_<field>_batch is called once per page and values are looked up by pk"""
+
+        url = reverse("staff-list-batch") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=20"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        rows = json.loads(response.content.decode('utf-8'))["aaData"]
+
+        self.assertEqual(len(rows), 20)
+        for row in rows:
+            self.assertEqual(row[-1], escape(Staff.objects.get(pk=row[0]).generic_object.name))
+
+        generic_queries = [q for q in queries if "staff_genericmodel" in q['sql']]
+        self.assertLessEqual(len(generic_queries), 2)
+
+    def test_batch_formatter_single_cell(self):
+        from staff.views import StaffListBatch
+
+        view = StaffListBatch()
+        view.request = mock.Mock()
+        obj = Staff.objects.first()
+        self.assertEqual(view.format_col("generic", obj), escape(obj.generic_object.name))
+
+        with mock.patch.object(StaffListBatch, "format_generic_batch", return_value={}):
+            self.assertEqual(view.format_col("generic", obj), "")
+
+    def test_generic_column(self):
+        """Columns traversing a GenericForeignKey are loaded with one query per content type"""
+
+        url = reverse("staff-list-generic") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=20"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        rows = json.loads(response.content.decode('utf-8'))["aaData"]
+
+        self.assertEqual(len(rows), 20)
+        for row in rows:
+            self.assertEqual(row[-1], escape(Staff.objects.get(pk=row[0]).generic_object.name))
+
+        generic_queries = [q for q in queries if "staff_genericmodel" in q['sql'] and "CASE" not in q['sql']]
+        self.assertLessEqual(len(generic_queries), 2)
+
+    def test_generic_column_sort(self):
+
+        url = reverse("staff-list-generic") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=20&iSortingCols=1&iSortCol_0=11&sSortDir_0=desc"
+        response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        rows = json.loads(response.content.decode('utf-8'))["aaData"]
+
+        names = sorted((s.generic_object.name for s in Staff.objects.all()), reverse=True)
+        self.assertEqual([unescape(row[-1]) for row in rows], names[:20])
+
+    def test_generic_column_filter(self):
+
+        for widget, search, expected in ((liviews.TEXT, "a2", ["A2"]), (liviews.SELECT, "B3", ["B3"])):
+            url = reverse("staff-list-generic") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=100&sSearch_11=%s" % search
+            with mock.patch("staff.views.StaffListGeneric.widgets", {"generic_object__name": widget}):
+                response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = json.loads(response.content.decode('utf-8'))
+
+            count = len([s for s in Staff.objects.all() if s.generic_object.name in expected])
+            self.assertTrue(count > 0)
+            self.assertEqual(data["iTotalDisplayRecords"], count)
+            self.assertEqual({row[-1] for row in data["aaData"]}, set(expected))
+
+    def test_generic_column_live_filters(self):
+
+        url = reverse("staff-list-generic") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10&sSearch_11=A"
+        with mock.patch("staff.views.StaffListGeneric.live_filters", True):
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        live_filters = json.loads(response.content.decode('utf-8'))['liveFilters']
+
+        # a column's own filter doesn't restrict its live filter values
+        names = {s.generic_object.name for s in Staff.objects.all()}
+        self.assertCountEqual(live_filters[11], names)
+
+        response = self.client.get(reverse("staff-list-generic"))
+        self.assertEqual(response.status_code, 200)
+
+    def test_generic_models_cached(self):
+        """The content types in use are only looked up once"""
+        from staff.views import StaffListGeneric
+
+        cache.clear()
+        generic_field = Staff._meta.get_field("generic_object")
+        with mock.patch.object(Staff._meta.get_field("content_type"), "get_limit_choices_to", return_value={}):
+            # without any cache settings the models are only memoised per view instance
+            view = StaffListGeneric()
+            with mock.patch("listable.cache.get_or_set") as get_or_set:
+                models = view.get_generic_models(Staff, generic_field)
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(view.get_generic_models(Staff, generic_field), models)
+                self.assertEqual(len(queries), 0)
+                with CaptureQueriesContext(connection) as queries:
+                    StaffListGeneric().get_generic_models(Staff, generic_field)
+                self.assertEqual(len(queries), 1)
+            get_or_set.assert_not_called()
+
+            with mock.patch("staff.views.StaffListGeneric.cache_total_count", True):
+                StaffListGeneric().get_generic_models(Staff, generic_field)
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(StaffListGeneric().get_generic_models(Staff, generic_field), models)
+                self.assertEqual(len(queries), 0)
+
+                # saving a staff member may change the content types in use
+                Staff.objects.first().save()
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertEqual(StaffListGeneric().get_generic_models(Staff, generic_field), models)
+                self.assertEqual(len(queries), 1)
+
+        self.assertCountEqual(models, [GenericModelA, GenericModelB])
+
+    def test_generic_column_missing_object(self):
+        """A cell whose generic object doesn't exist is rendered empty"""
+
+        staff = Staff.objects.order_by("pk").first()
+        Staff.objects.filter(pk=staff.pk).update(object_id=999999)
+
+        url = reverse("staff-list-generic") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10&iSortingCols=1&iSortCol_0=0&sSortDir_0=asc"
+        rows = json.loads(self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest').content.decode('utf-8'))["aaData"]
+        self.assertEqual(rows[0][0], str(staff.pk))
+        self.assertEqual(rows[0][-1], "")
+
+    def test_generic_column_filter_options(self):
+        from staff.views import StaffListGeneric
+
+        view = StaffListGeneric()
+        view.request = mock.Mock()
+        filters = view.get_filters("generic_object__name", queryset=Staff.objects.all())
+
+        names = sorted({s.generic_object.name for s in Staff.objects.all()})
+        self.assertEqual(filters, [(n, n) for n in names])
+
+    def test_get_filters_distinct(self):
+        """Select options are de-duplicated in the database but keep the ordering
+        of selecting every row and removing duplicates"""
+
+        view = StaffList()
+        field = "position__name"
+        for ordering in (None, field, "-" + field, "department__name", "-department__name", ("department__name", "last_name")):
+            order_fields = {field: ordering} if ordering else {}
+            with mock.patch("staff.views.StaffList.order_fields", order_fields):
+                with CaptureQueriesContext(connection) as queries:
+                    filters = view.get_filters(field, queryset=Staff.objects.all())
+
+            # the field itself is used to break ties
+            expected = unique(Staff.objects.values_list(field, field).order_by(*(
+                ((ordering,) if isinstance(ordering, str) else ordering or ()) + (field,)
+            )))
+            self.assertEqual(filters, expected)
+            self.assertTrue("DISTINCT" in queries[0]['sql'] or "GROUP BY" in queries[0]['sql'])
+
+    async def _async_payloads(self, query):
+        headers = {"x-requested-with": "XMLHttpRequest"}
+        url = "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10" + query
+        response = await sync_to_async(self.client.get)(reverse("staff-list-live-filters") + url, headers=headers)
+        async_response = await self.async_client.get(reverse("staff-list-async") + url, headers=headers)
+        return json.loads(response.content.decode('utf-8')), json.loads(async_response.content.decode('utf-8'))
+
+    async def test_async_view(self):
+        """The async view should return the same data as the sync view"""
+
+        queries = (
+            "",
+            "&iDisplayStart=30&iSortingCols=1&iSortCol_0=1&sSortDir_0=desc",
+            "&sSearch_2=inactive",
+            "&sSearch_9=%5E(Other%60%7C%60Part%2520Time%2520Contract)%24&iDisplayStart=10",
+        )
+        for query in queries:
+            expected, payload = await self._async_payloads(query)
+            self.assertEqual(payload, expected)
+            self.assertTrue(payload["aaData"])
+
+        response = await self.async_client.get(reverse("staff-list-async"))
+        self.assertEqual(response.status_code, 200)
+
+        url = reverse("staff-list-async") + "?sEcho=1&iColumns=12&iDisplayStart=10&iDisplayLength=10&sSearch_2=inactive"
+        response = await self.async_client.get(url, headers={"x-requested-with": "XMLHttpRequest"})
+        self.assertEqual(response.status_code, 404)
+
+    async def test_async_view_options(self):
+        """Deferred joins, other count strategies & cached/union live filters fall back to sync calls"""
+
+        options = (
+            {"deferred_join": True},
+            {"count_strategy": liviews.COUNT_CAPPED, "count_cap": 50},
+            {"count_strategy": liviews.COUNT_WINDOW},
+            {"cache_live_filters": True, "cache_total_count": True, "live_filters_union": True},
+        )
+        for attrs in options:
+            await sync_to_async(cache.clear)()
+            with mock.patch.multiple("staff.views.StaffListLiveFilters", **attrs):
+                expected, payload = await self._async_payloads("&sSearch_2=active&iDisplayStart=20")
+            self.assertEqual(payload, expected)
+
+    async def test_async_view_django_version(self):
+        with mock.patch("django.VERSION", (4, 0, 0, "final", 0)), self.assertRaises(ImproperlyConfigured):
+            await self.async_client.get(reverse("staff-list-async"))
+
+    async def test_async_view_streaming(self):
+        """Streamed pages & exports are sent a chunk at a time by the async view"""
+
+        async def content(response):
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+            self.assertGreater(len(chunks), 2)
+            return b"".join(chunks).decode('utf-8')
+
+        query = "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=20&sSearch_2=active"
+        headers = {"x-requested-with": "XMLHttpRequest"}
+        attrs = {"streaming": True, "streaming_page_size": 10, "streaming_chunk_size": 3, "export_formats": ("csv",)}
+        with mock.patch.multiple("staff.views.StaffListLiveFilters", **attrs):
+            for query, headers in ((query, headers), (query + "&sExport=csv", {})):
+                response = await sync_to_async(self.client.get)(reverse("staff-list-live-filters") + query, headers=headers)
+                expected = await sync_to_async(lambda: b"".join(response.streaming_content).decode('utf-8'))()
+
+                response = await self.async_client.get(reverse("staff-list-async") + query, headers=headers)
+                self.assertEqual(await content(response), expected)
+
+    def test_page_offset(self):
+        view = StaffList()
+        view.search_filters = {"iDisplayStart": "25"}
+        self.assertEqual(view.get_page_offset(10), 20)
+        self.assertEqual(view.get_page_offset(-1), 25)
+        view.check_page_exists([], 0, 10)
+        with self.assertRaises(liviews.Http404):
+            view.check_page_exists([], 20, 10)
+
+    def test_concurrent_queries_in_transaction(self):
+        """Queries aren't sent to the thread pool inside a transaction"""
+
+        url = reverse("staff-list-live-filters") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10"
+        with mock.patch("staff.views.StaffListLiveFilters.concurrent_queries", 4):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len([q for q in queries if "COUNT(*)" in q['sql']]), 2)
+
+
+class TestConcurrentQueries(TransactionTestCase):
+
+    fixtures = ["staff_data.json"]
+
+    def _payload(self, query):
+        url = reverse("staff-list-live-filters") + "?sEcho=1&iColumns=12&iDisplayStart=0&iDisplayLength=10" + query
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return response, queries
+
+    def test_concurrent_queries(self):
+        """The thread pool returns the same data with no count, page or live filter queries on the request thread"""
+
+        options = (
+            {"deferred_join": False},
+            {"deferred_join": True},
+            {"live_filters_union": True},
+            {"count_strategy": liviews.COUNT_CAPPED, "count_cap": 50},
+        )
+        for attrs in options:
+            for query in ("", "&sSearch_2=active&iDisplayStart=20&iSortingCols=1&iSortCol_0=1&sSortDir_0=desc"):
+                with mock.patch.multiple("staff.views.StaffListLiveFilters", **attrs):
+                    expected = json.loads(self._payload(query)[0].content.decode('utf-8'))
+                    with mock.patch("staff.views.StaffListLiveFilters.concurrent_queries", 4):
+                        response, queries = self._payload(query)
+
+                self.assertEqual(json.loads(response.content.decode('utf-8')), expected)
+                self.assertEqual([q['sql'] for q in queries if 'FROM "staff_staff"' in q['sql']], [])
+
+    def test_concurrent_queries_past_end(self):
+
+        with mock.patch("staff.views.StaffListLiveFilters.concurrent_queries", 4):
+            response, __ = self._payload("&sSearch_2=inactive&iDisplayStart=10")
+        self.assertEqual(response.status_code, 404)